@@ -0,0 +1,175 @@
+"""AI 缓存模块：基于向量相似度的语义缓存，复用近似重复请求的分析结果
+
+依赖 numpy 与 sentence-transformers（可选依赖），未安装时语义缓存自动禁用。
+"""
+import json
+import logging
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+# 参与向量化的文本最大长度（字符）
+MAX_EMBED_CHARS = 4096
+
+# 缓存条目数上限，超过后在写盘时淘汰最早的条目
+MAX_ENTRIES = 5000
+
+
+class SemanticCache:
+    """
+    语义缓存：将请求文本向量化，与已缓存请求做余弦相似度比较，
+    相似度超过阈值时直接返回之前的分析结果。
+
+    缓存按 scope（如 chat_id + thread_id + model）隔离，避免不同群组/线程之间串用结果。
+    向量保存在 embeddings.npy（float32，已归一化），结果保存在 entries.json。
+    新条目只追加到内存中，由 flush() 统一写盘（每次生成报告后调用一次）。
+    """
+
+    def __init__(self, cache_dir: Path, threshold: float = 0.92, model_name: str = "all-MiniLM-L6-v2") -> None:
+        import numpy as np
+        from sentence_transformers import SentenceTransformer
+
+        self._np = np
+        self._model = SentenceTransformer(model_name)
+        self.cache_dir = cache_dir
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._emb_path = cache_dir / "embeddings.npy"
+        self._entries_path = cache_dir / "entries.json"
+        dim = self._model.get_sentence_embedding_dimension()
+        # 向量缓冲区按容量倍增，前 len(self._entries) 行有效，追加条目时无需每次复制整个矩阵
+        self._embeddings = np.zeros((0, dim), dtype=np.float32)
+        # 与向量缓冲区平行的 scope 编号，查找时用向量化比较生成掩码，不再逐条比较字符串
+        self._scope_ids = np.zeros(0, dtype=np.int32)
+        self._scope_codes: Dict[str, int] = {}
+        self._entries: List[Dict[str, Any]] = []
+        self._dirty = False
+        self._load()
+
+    def _load(self) -> None:
+        """从磁盘加载已有缓存，文件缺失或不一致时从空缓存开始"""
+        if not (self._emb_path.exists() and self._entries_path.exists()):
+            return
+        try:
+            embeddings = self._np.load(self._emb_path)
+            entries = json.loads(self._entries_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as exc:
+            log.warning("Failed to load semantic cache from %s: %s", self.cache_dir, exc)
+            return
+        if len(entries) != embeddings.shape[0] or embeddings.shape[1] != self._embeddings.shape[1]:
+            log.warning("Semantic cache in %s is inconsistent, ignoring it", self.cache_dir)
+            return
+        self._embeddings = embeddings.astype(self._np.float32, copy=False)
+        self._entries = entries
+        self._scope_ids = self._np.array([self._scope_code(e["scope"]) for e in entries], dtype=self._np.int32)
+
+    def _scope_code(self, scope: str) -> int:
+        """返回 scope 对应的整数编号，首次出现时分配新编号"""
+        code = self._scope_codes.get(scope)
+        if code is None:
+            code = self._scope_codes[scope] = len(self._scope_codes)
+        return code
+
+    def _save(self) -> None:
+        """原子写入向量和结果文件（调用方需持有 self._lock，临时文件名固定，不能并发写入）"""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_emb = self._emb_path.with_name("embeddings.tmp.npy")
+        tmp_entries = self._entries_path.with_suffix(".tmp")
+        self._np.save(tmp_emb, self._embeddings[:len(self._entries)])
+        tmp_entries.write_text(json.dumps(self._entries, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_emb, self._emb_path)
+        os.replace(tmp_entries, self._entries_path)
+
+    def embed(self, text: str) -> Any:
+        """将请求的规范化文本向量化（已归一化的 float32 向量），供 lookup / insert 复用"""
+        vec = self._model.encode(text[:MAX_EMBED_CHARS], normalize_embeddings=True)
+        return self._np.asarray(vec, dtype=self._np.float32)
+
+    def lookup(self, scope: str, vec: Any) -> Optional[Dict[str, Any]]:
+        """
+        查找语义相近的缓存结果
+
+        Args:
+            scope: 缓存隔离范围，只在相同 scope 的条目中查找
+            vec: embed() 返回的请求向量
+
+        Returns:
+            命中时返回缓存的分析结果，否则返回 None
+        """
+        with self._lock:
+            code = self._scope_codes.get(scope)
+            if code is None or not self._entries:
+                return None
+            size = len(self._entries)
+            mask = self._scope_ids[:size] == code
+            if not mask.any():
+                return None
+            sims = self._np.where(mask, self._embeddings[:size] @ vec, -1.0)
+            best = int(sims.argmax())
+            if sims[best] <= self.threshold:
+                return None
+            log.info("Semantic cache hit (similarity=%.3f, scope=%s)", sims[best], scope)
+            return self._entries[best]["response"]
+
+    def insert(self, scope: str, vec: Any, response: Dict[str, Any]) -> None:
+        """在内存中追加一条缓存（请求向量 + 分析结果），由 flush() 写盘"""
+        with self._lock:
+            size = len(self._entries)
+            if size == self._embeddings.shape[0]:
+                grown = self._np.zeros((max(2 * size, 16), self._embeddings.shape[1]), dtype=self._np.float32)
+                grown[:size] = self._embeddings
+                self._embeddings = grown
+                grown_ids = self._np.zeros(grown.shape[0], dtype=self._np.int32)
+                grown_ids[:size] = self._scope_ids[:size]
+                self._scope_ids = grown_ids
+            self._embeddings[size] = vec
+            self._scope_ids[size] = self._scope_code(scope)
+            self._entries.append({"scope": scope, "response": response})
+            self._dirty = True
+
+    def flush(self) -> None:
+        """将新增条目写盘，超过 MAX_ENTRIES 时先淘汰最早的条目；没有新增时不写"""
+        with self._lock:
+            if not self._dirty:
+                return
+            overflow = len(self._entries) - MAX_ENTRIES
+            if overflow > 0:
+                self._embeddings = self._embeddings[overflow:len(self._entries)].copy()
+                self._scope_ids = self._scope_ids[overflow:len(self._entries)].copy()
+                self._entries = self._entries[overflow:]
+            try:
+                self._save()
+            except OSError as exc:
+                log.warning("Failed to save semantic cache to %s: %s", self.cache_dir, exc)
+                return
+            self._dirty = False
+
+
+# 保护语义缓存实例的创建：lru_cache 不阻止并发的首次调用各自加载模型、各自写同一组文件
+_SEMANTIC_CACHE_LOCK = threading.Lock()
+
+
+def get_semantic_cache(cache_dir: Path, threshold: float, model_name: str) -> Optional[SemanticCache]:
+    """
+    获取（同一进程内复用）语义缓存实例，多线程并发调用时只创建一个实例
+
+    Returns:
+        SemanticCache 实例；缺少可选依赖或加载模型失败时返回 None
+    """
+    with _SEMANTIC_CACHE_LOCK:
+        return _load_semantic_cache(cache_dir, threshold, model_name)
+
+
+@lru_cache(maxsize=4)
+def _load_semantic_cache(cache_dir: Path, threshold: float, model_name: str) -> Optional[SemanticCache]:
+    try:
+        return SemanticCache(cache_dir, threshold=threshold, model_name=model_name)
+    except ImportError as exc:
+        log.warning("Semantic cache disabled: %s (pip install numpy sentence-transformers)", exc)
+    except Exception as exc:
+        log.warning("Semantic cache disabled: failed to load model %s: %s", model_name, exc)
+    return None
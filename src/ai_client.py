@@ -1,18 +1,83 @@
+import hashlib
 import logging
 import json
+import os
 import re
-from typing import Any, Dict, List, Optional
+import tempfile
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
 
 import httpx
+import orjson
 
+from ai_cache import SemanticCache
 
 log = logging.getLogger(__name__)
 
+# 模块级共享的 HTTP 客户端：复用 TCP/TLS 连接（keep-alive），避免每次请求重新握手
+_CLIENT: Optional[httpx.Client] = None
+_CLIENT_LOCK = threading.Lock()
+
+_JSON_DECODER = json.JSONDecoder()
+
+# markdown 代码块的开头标记（```json 或 ```），结尾标记用 str.find 查找
+_CODE_FENCE_OPEN_RE = re.compile(r'```(?:json)?[ \t]*\r?\n?')
+
+# 温度高于此值时输出随机性较大，不使用响应缓存
+_CACHE_MAX_TEMPERATURE = 0.5
+
 
 class AISummaryError(RuntimeError):
     pass
 
 
+def _get_client() -> httpx.Client:
+    """获取（必要时创建）共享的 httpx.Client，连接池在多次 AI 请求间复用"""
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = httpx.Client(
+                    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                    timeout=httpx.Timeout(120.0),
+                )
+    return _CLIENT
+
+
+def close_client() -> None:
+    """关闭共享的 httpx.Client，释放连接池（用于程序退出时清理）"""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is not None:
+            _CLIENT.close()
+            _CLIENT = None
+
+
+def _loads(text: str) -> Any:
+    """优先用 orjson 解析 JSON；orjson 不支持的输入（如 NaN）回退到标准库 json"""
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        return json.loads(text)
+
+
+def _as_result(value: Any) -> Optional[Dict[str, Any]]:
+    """
+    将解析出的 JSON 值规范为分析结果字典
+
+    对象原样返回；元素全为对象的数组包装成 {"categories": [...]}；
+    其他值（数字、字符串、含非对象元素的数组等）不是有效结果，返回 None
+    """
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, list) and all(isinstance(item, dict) for item in value):
+        return {"categories": value}
+    return None
+
+
 def _extract_json_from_content(content: str) -> Dict[str, Any]:
     """
     从模型返回的内容中提取 JSON 对象。
@@ -39,101 +104,44 @@ def _extract_json_from_content(content: str) -> Dict[str, Any]:
     content = content.strip()
     
     # 情况1: 尝试直接解析（纯 JSON）
-    try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        pass
+    # 只有内容以 } 或 ] 结尾时才可能是完整 JSON，否则（截断或纯文本回复）跳过这次必然失败的解析
+    if content and content[-1] in "}]":
+        try:
+            result = _as_result(_loads(content))
+        except json.JSONDecodeError:
+            result = None
+        if result is not None:
+            return result
     
     # 情况2: 处理 markdown 代码块格式（```json ... ``` 或 ``` ... ```）
-    # 匹配 ```json ... ``` 或 ``` ... ```
-    code_block_pattern = r'```(?:json)?\s*\n?(.*?)\n?```'
-    match = re.search(code_block_pattern, content, re.DOTALL)
+    # 先用无回溯的正则定位开头的 ```，再用 str.find 线性查找结尾的 ```，
+    # 避免 (.*?) + DOTALL 在缺少结尾标记的长文本上出现灾难性回溯
+    match = _CODE_FENCE_OPEN_RE.search(content)
     if match:
-        json_str = match.group(1).strip()
+        end = content.find('```', match.end())
+        if end != -1:
+            json_str = content[match.end():end].strip()
+            try:
+                result = _as_result(_loads(json_str))
+            except json.JSONDecodeError:
+                result = None
+            if result is not None:
+                return result
+    
+    # 情况3/4: 先从第一个 { 开始提取 JSON 对象，失败再从第一个 [ 开始提取数组
+    # raw_decode 在 C 层完成括号匹配与字符串转义处理，解析到完整值即停止，忽略后缀文本；
+    # 每种括号只尝试第一个起点：截断或无效的输出直接报错，不退而解析其中恰好完整的内层对象
+    for opener in "{[":
+        start = content.find(opener)
+        if start < 0:
+            continue
         try:
-            return json.loads(json_str)
+            value, _ = _JSON_DECODER.raw_decode(content, start)
         except json.JSONDecodeError:
-            pass
-    
-    # 情况3: 尝试从文本中提取 JSON 对象（使用括号匹配）
-    # 从第一个 { 开始，尝试找到匹配的 }
-    start_idx = content.find('{')
-    if start_idx >= 0:
-        brace_count = 0
-        in_string = False
-        escape_next = False
-        
-        for i in range(start_idx, len(content)):
-            char = content[i]
-            
-            # 处理转义字符
-            if escape_next:
-                escape_next = False
-                continue
-            
-            if char == '\\':
-                escape_next = True
-                continue
-            
-            # 处理字符串边界
-            if char == '"' and not escape_next:
-                in_string = not in_string
-                continue
-            
-            # 只在非字符串状态下计算括号
-            if not in_string:
-                if char == '{':
-                    brace_count += 1
-                elif char == '}':
-                    brace_count -= 1
-                    if brace_count == 0:
-                        json_str = content[start_idx:i+1]
-                        try:
-                            return json.loads(json_str)
-                        except json.JSONDecodeError:
-                            break
-    
-    # 情况4: 尝试查找 JSON 数组（如果返回的是数组格式）
-    # 从第一个 [ 开始，尝试找到匹配的 ]
-    start_idx = content.find('[')
-    if start_idx >= 0:
-        bracket_count = 0
-        in_string = False
-        escape_next = False
-        
-        for i in range(start_idx, len(content)):
-            char = content[i]
-            
-            # 处理转义字符
-            if escape_next:
-                escape_next = False
-                continue
-            
-            if char == '\\':
-                escape_next = True
-                continue
-            
-            # 处理字符串边界
-            if char == '"' and not escape_next:
-                in_string = not in_string
-                continue
-            
-            # 只在非字符串状态下计算括号
-            if not in_string:
-                if char == '[':
-                    bracket_count += 1
-                elif char == ']':
-                    bracket_count -= 1
-                    if bracket_count == 0:
-                        json_str = content[start_idx:i+1]
-                        try:
-                            result = json.loads(json_str)
-                            # 如果解析成功但返回的是数组，包装成字典
-                            if isinstance(result, list):
-                                return {"categories": result}
-                            return result
-                        except json.JSONDecodeError:
-                            break
+            continue
+        result = _as_result(value)
+        if result is not None:
+            return result
     
     # 如果所有方法都失败，抛出错误
     raise AISummaryError(
@@ -141,27 +149,109 @@ def _extract_json_from_content(content: str) -> Dict[str, Any]:
     )
 
 
-def call_chat_analysis(
-    api_base: str,
-    api_key: str,
-    payload: Dict[str, Any],
-    model: str = "grok-beta",
-    timeout: float = 120.0,
-) -> Dict[str, Any]:
+def _restrict_message_ids(result: Dict[str, Any], message_ids: Set[Any]) -> Dict[str, Any]:
     """
-    Call x.ai-compatible chat/completions and ask model to return structured JSON.
+    返回语义缓存命中结果的副本，各分类的 messages 只保留当前请求中出现的消息ID
+
+    命中的结果来自另一批相似消息，其中的消息ID可能属于其他批次或其他日期，
+    直接引用会在报告中链接到无关消息
     """
-    url = api_base.rstrip("/") + "/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-
-    # 从 payload 中提取群组类型和名称
-    chat_type = payload.get("chat_type")  # "crypto" 或 "tech" 或 "news" 或 None
-    chat_name = payload.get("chat_name", "")
+    restricted = dict(result)
+    restricted["categories"] = [
+        {**cat, "messages": [mid for mid in cat.get("messages") or [] if mid in message_ids]}
+        if isinstance(cat, dict) else cat
+        for cat in result.get("categories") or []
+    ]
+    return restricted
+
+
+def _cache_path(cache_dir: Path, data: Dict[str, Any]) -> Path:
+    """
+    根据请求内容计算缓存文件路径（内容寻址）
     
-    # 构建系统提示词
+    缓存键为 model + messages + temperature 的 SHA-256，
+    按前两位十六进制字符分子目录，避免单个目录下文件过多。
+    """
+    key_src = orjson.dumps(
+        {"model": data["model"], "messages": data["messages"], "temperature": data["temperature"]},
+        option=orjson.OPT_SORT_KEYS,
+    )
+    key = hashlib.sha256(key_src).hexdigest()
+    return cache_dir / key[:2] / f"{key}.json"
+
+
+def _read_cache(path: Path, max_age: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """读取缓存的分析结果，不存在、损坏或超过 max_age 秒（按文件修改时间）时返回 None"""
+    try:
+        if max_age is not None and time.time() - path.stat().st_mtime > max_age:
+            return None
+        return orjson.loads(path.read_bytes())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        log.warning("Ignoring unreadable AI cache file %s: %s", path, exc)
+        return None
+
+
+def _write_cache(path: Path, result: Dict[str, Any]) -> None:
+    """
+    原子写入分析结果（先写临时文件再 os.replace），写入失败不影响主流程
+    
+    临时文件名每次唯一，重叠运行或并发写同一个键时不会替换进别人写了一半的文件
+    """
+    tmp_name: Optional[str] = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = orjson.dumps(result)
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.stem, suffix=".tmp", delete=False) as tmp:
+            tmp_name = tmp.name
+            tmp.write(data)
+        os.replace(tmp_name, path)
+    except (OSError, TypeError) as exc:
+        log.warning("Failed to write AI cache file %s: %s", path, exc)
+        if tmp_name is not None:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+
+
+# 用户提示词的固定前缀（输入数据之前的说明部分）
+_USER_PROMPT_PREAMBLE = "\n".join([
+    "请分析以下群聊消息，严格按照上述要求提取结构性信息。",
+    "",
+    "**重要：请按照对话模式分析，而不是孤立地分析每条消息：**",
+    "",
+    "1. **时间顺序**：消息已按时间顺序排列（ts字段），请严格按照时间先后顺序理解对话流程。",
+    "   例如：2025-11-24 09:00:00 的消息应该在 2025-11-24 12:05:44 的消息前面被理解。",
+    "",
+    "2. **对话逻辑**：",
+    "   - 识别对话的起始、发展和结论",
+    "   - 理解消息之间的因果关系和回复关系（注意 reply_to 和 replied_message 字段）",
+    "   - 推理出对话的整体逻辑和连贯性",
+    "   - 将每条消息放在整个对话的上下文中理解",
+    "",
+    "3. **提取信息**：",
+    "   - 优先提取事件类信息（项目发布、漏洞、攻击、更新等）",
+    "   - 忽略噪音类信息（闲聊、无意义争论、表情包等）",
+    "   - 观点类信息仅保留有价值的市场判断或技术观点",
+    "   - 如果消息中没有任何有价值信息，overall 可以说明'本线程主要为闲聊，无重要信息'",
+    "",
+    "输入数据：",
+])
+
+
+@lru_cache(maxsize=8)
+def _build_sys_prompt(chat_type: Optional[str]) -> str:
+    """
+    构建系统提示词（按群组类型缓存，同一类型只拼接一次）
+    
+    Args:
+        chat_type: 群组类型（"crypto" / "tech" / "news" / None）
+    
+    Returns:
+        完整的系统提示词
+    """
     sys_prompt_parts = [
         "你是一个专业的群聊消息分析助手，擅长从大量聊天记录中提取真正有价值的结构性信息。",
         "",
@@ -278,84 +368,214 @@ def call_chat_analysis(
         "请用中文回答。",
     ])
     
-    sys_prompt = "\n".join(sys_prompt_parts)
-    
-    # 构建用户提示词
-    user_prompt_parts = [
-        "请分析以下群聊消息，严格按照上述要求提取结构性信息。",
-        "",
-        "**重要：请按照对话模式分析，而不是孤立地分析每条消息：**",
-        "",
-        "1. **时间顺序**：消息已按时间顺序排列（ts字段），请严格按照时间先后顺序理解对话流程。",
-        "   例如：2025-11-24 09:00:00 的消息应该在 2025-11-24 12:05:44 的消息前面被理解。",
-        "",
-        "2. **对话逻辑**：",
-        "   - 识别对话的起始、发展和结论",
-        "   - 理解消息之间的因果关系和回复关系（注意 reply_to 和 replied_message 字段）",
-        "   - 推理出对话的整体逻辑和连贯性",
-        "   - 将每条消息放在整个对话的上下文中理解",
-        "",
-        "3. **提取信息**：",
-        "   - 优先提取事件类信息（项目发布、漏洞、攻击、更新等）",
-        "   - 忽略噪音类信息（闲聊、无意义争论、表情包等）",
-        "   - 观点类信息仅保留有价值的市场判断或技术观点",
-        "   - 如果消息中没有任何有价值信息，overall 可以说明'本线程主要为闲聊，无重要信息'",
-        "",
-        "输入数据：",
-    ]
+    return "\n".join(sys_prompt_parts)
+
+
+_TIMEOUT_ERRORS = (
+    httpx.ReadTimeout,
+    httpx.ConnectTimeout,
+    httpx.WriteTimeout,
+    httpx.PoolTimeout,
+    httpx.TimeoutException,
+)
+
+
+class _ChatRequest:
+    """
+    一次 AI 分析请求：构建请求体、查找/写入缓存、解析响应。
+    普通请求与流式（SSE）请求共用此逻辑，只有读取响应的方式不同。
+    """
     
-    user_prompt = "\n".join(user_prompt_parts) + "\n" + json.dumps(payload, ensure_ascii=False, indent=2)
+    def __init__(
+        self,
+        api_base: str,
+        api_key: str,
+        payload: Dict[str, Any],
+        model: str,
+        cache_dir: Optional[Path],
+        semantic_cache: Optional[SemanticCache],
+        stream: bool = False,
+        cache_ttl: Optional[float] = None,
+    ) -> None:
+        self.url = api_base.rstrip("/") + "/chat/completions"
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        self.model = model
 
-    data: Dict[str, Any] = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": sys_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        "temperature": 0.2,
-    }
+        # 从 payload 中提取群组类型
+        chat_type = payload.get("chat_type")  # "crypto" 或 "tech" 或 "news" 或 None
+        
+        # 系统提示词只取决于群组类型，缓存构建结果；用户提示词的固定前缀为模块常量
+        self.sys_prompt = _build_sys_prompt(chat_type)
+        self.user_prompt = _USER_PROMPT_PREAMBLE + "\n" + orjson.dumps(payload).decode()
 
-    log.info("AI request prompt (system): %s", sys_prompt)
-    log.info("AI request prompt (user): %s", user_prompt)
+        self.data: Dict[str, Any] = {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": self.sys_prompt},
+                {"role": "user", "content": self.user_prompt},
+            ],
+            "temperature": 0.2,
+        }
+        if stream:
+            self.data["stream"] = True
+        # 请求体用 orjson 预先序列化为 bytes，直接作为 content 发送（不经过 httpx 内部的标准库 json）
+        self.body = orjson.dumps(self.data)
 
-    try:
-        resp = httpx.post(url, headers=headers, json=data, timeout=timeout)
-    except (
-        httpx.ReadTimeout,
-        httpx.ConnectTimeout,
-        httpx.WriteTimeout,
-        httpx.PoolTimeout,
-        httpx.TimeoutException,
-    ) as exc:
-        raise AISummaryError(f"请求超时（{timeout}秒），请尝试增加 ai_timeout 配置或检查网络连接") from exc
-    except Exception as exc:  # pragma: no cover - network errors
-        raise AISummaryError(f"请求失败: {exc}") from exc
+        self.cache_path: Optional[Path] = None
+        self.cache_ttl = cache_ttl
+        if cache_dir is not None and self.data["temperature"] <= _CACHE_MAX_TEMPERATURE:
+            self.cache_path = _cache_path(cache_dir, self.data)
 
-    log.info("AI raw response status=%s body=%s", resp.status_code, resp.text)
+        self.semantic_cache = semantic_cache
+        # 按群组 + 线程 + 模型隔离语义缓存，命中结果中的消息ID才可能属于当前线程
+        self.semantic_scope = f"{payload.get('chat_id')}:{payload.get('thread_id')}:{model}"
+        self.semantic_text = ""
+        self.message_ids: Set[Any] = set()
+        # 请求向量在查找语义缓存时计算一次，未命中时写入缓存直接复用
+        self.semantic_vec: Any = None
+        if semantic_cache is not None:
+            messages = payload.get("messages") or []
+            self.semantic_text = " ".join(m.get("text") or "" for m in messages)
+            self.message_ids = {m.get("id") for m in messages}
 
-    if resp.status_code >= 400:
-        raise AISummaryError(f"bad status {resp.status_code}: {resp.text}")
+    def cached_result(self) -> Optional[Dict[str, Any]]:
+        """依次查找精确缓存和语义缓存，未命中返回 None"""
+        if self.cache_path is not None:
+            cached = _read_cache(self.cache_path, self.cache_ttl)
+            if cached is not None:
+                log.info("AI cache hit: %s", self.cache_path.name)
+                return cached
+        if self.semantic_cache is not None:
+            self.semantic_vec = self.semantic_cache.embed(self.semantic_text)
+            hit = self.semantic_cache.lookup(self.semantic_scope, self.semantic_vec)
+            if hit is not None:
+                return _restrict_message_ids(hit, self.message_ids)
+        return None
 
-    try:
-        body = resp.json()
-    except Exception as exc:
-        raise AISummaryError(f"invalid JSON response: {exc}") from exc
+    def log_request(self) -> None:
+        log.debug("AI request prompt (system): %s", self.sys_prompt)
+        log.debug("AI request prompt (user): %s", self.user_prompt)
+        log.info("AI request sent model=%s bytes=%d", self.model, len(self.body))
 
-    content: Optional[str] = None
-    try:
-        choices: List[Dict[str, Any]] = body.get("choices") or []
-        if choices:
-            content = choices[0].get("message", {}).get("content")
-    except Exception:
-        content = None
+    def handle_response(self, resp: httpx.Response) -> Dict[str, Any]:
+        """校验并解析响应，成功时写入缓存"""
+        # resp.text 会解码整个响应体，仅在 DEBUG 级别下才生成
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("AI raw response status=%s body=%s", resp.status_code, resp.text)
 
-    if not content:
-        raise AISummaryError("no content returned from model")
+        if resp.status_code >= 400:
+            raise AISummaryError(f"bad status {resp.status_code}: {resp.text}")
+
+        try:
+            body = orjson.loads(resp.content)
+        except Exception as exc:
+            raise AISummaryError(f"invalid JSON response: {exc}") from exc
 
+        content: Optional[str] = None
+        try:
+            choices: List[Dict[str, Any]] = body.get("choices") or []
+            if choices:
+                content = choices[0].get("message", {}).get("content")
+        except Exception:
+            content = None
+
+        return self.finish(content)
+
+    def handle_stream(self, resp: httpx.Response) -> Dict[str, Any]:
+        """
+        逐行读取 SSE 流式响应（data: {...}），累积 choices[0].delta.content 后解析。
+        片段先追加到列表，最后一次性 join，避免字符串反复拼接。
+        """
+        if resp.status_code >= 400:
+            resp.read()
+            raise AISummaryError(f"bad status {resp.status_code}: {resp.text}")
+
+        chunks: List[str] = []
+        for line in resp.iter_lines():
+            if not line.startswith("data:"):
+                continue
+            event_data = line[5:].strip()
+            if event_data == "[DONE]":
+                break
+            try:
+                event = orjson.loads(event_data)
+            except orjson.JSONDecodeError:
+                log.debug("Ignoring malformed stream chunk: %s", event_data[:200])
+                continue
+            for choice in event.get("choices") or []:
+                piece = (choice.get("delta") or {}).get("content")
+                if piece:
+                    chunks.append(piece)
+
+        return self.finish("".join(chunks))
+
+    def finish(self, content: Optional[str]) -> Dict[str, Any]:
+        """从模型输出中提取 JSON 结果，成功时写入缓存"""
+        if not content:
+            raise AISummaryError("no content returned from model")
+
+        try:
+            result = _extract_json_from_content(content)
+        except AISummaryError:
+            # 重新抛出 AISummaryError，保持原始错误信息
+            raise
+        except Exception as exc:
+            raise AISummaryError(f"解析 JSON 时发生错误: {exc}，内容预览: {content[:200]}...") from exc
+        if not isinstance(result, dict):
+            # 非字典结果无法渲染，不能写入缓存（否则之后每次运行都会复用这个错误结果）
+            raise AISummaryError(f"模型返回的 JSON 不是对象，内容预览: {content[:200]}...")
+
+        if self.cache_path is not None:
+            _write_cache(self.cache_path, result)
+        if self.semantic_cache is not None:
+            if self.semantic_vec is None:
+                self.semantic_vec = self.semantic_cache.embed(self.semantic_text)
+            self.semantic_cache.insert(self.semantic_scope, self.semantic_vec, result)
+        return result
+
+
+def call_chat_analysis(
+    api_base: str,
+    api_key: str,
+    payload: Dict[str, Any],
+    model: str = "grok-beta",
+    timeout: float = 120.0,
+    cache_dir: Optional[Path] = None,
+    semantic_cache: Optional[SemanticCache] = None,
+    stream: bool = False,
+    cache_ttl: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Call x.ai-compatible chat/completions and ask model to return structured JSON.
+
+    If cache_dir is given, identical requests (same model, prompts and temperature)
+    are answered from an on-disk cache instead of calling the API again;
+    entries older than cache_ttl seconds are ignored and refreshed.
+    If semantic_cache is given, near-duplicate message sets of the same chat
+    reuse a previous result when their embeddings are similar enough.
+    New semantic entries stay in memory until the caller calls semantic_cache.flush().
+    If stream is True, the completion is requested as server-sent events and
+    consumed incrementally instead of buffering the whole response body.
+    """
+    req = _ChatRequest(api_base, api_key, payload, model, cache_dir, semantic_cache, stream=stream, cache_ttl=cache_ttl)
+    cached = req.cached_result()
+    if cached is not None:
+        return cached
+
+    req.log_request()
     try:
-        return _extract_json_from_content(content)
+        if stream:
+            with _get_client().stream("POST", req.url, headers=req.headers, content=req.body, timeout=timeout) as resp:
+                return req.handle_stream(resp)
+        resp = _get_client().post(req.url, headers=req.headers, content=req.body, timeout=timeout)
     except AISummaryError:
-        # 重新抛出 AISummaryError，保持原始错误信息
         raise
-    except Exception as exc:
-        raise AISummaryError(f"解析 JSON 时发生错误: {exc}，内容预览: {content[:200]}...") from exc
+    except _TIMEOUT_ERRORS as exc:
+        raise AISummaryError(f"请求超时（{timeout}秒），请尝试增加 ai_timeout 配置或检查网络连接") from exc
+    except Exception as exc:  # pragma: no cover - network errors
+        raise AISummaryError(f"请求失败: {exc}") from exc
+
+    return req.handle_response(resp)
@@ -1,16 +1,26 @@
 """配置模块：处理应用配置的加载和解析"""
-import json
 import logging
 from datetime import timezone
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
+import orjson
+
 log = logging.getLogger(__name__)
 
 
 class ChatConfig:
     """单个群组的配置"""
     
+    __slots__ = (
+        "chat_id",
+        "chat_link",
+        "name",
+        "chat_type",
+        "min_thread_messages",
+        "enable_thread_classification",
+    )
+    
     def __init__(self, raw: Dict[str, Any]) -> None:
         self.chat_id: int = int(raw.get("chat_id", 0))
         chat_link_raw = raw.get("chat_link")
@@ -50,6 +60,40 @@ class ChatConfig:
 class Config:
     """应用主配置类"""
     
+    # 属性固定，使用 __slots__ 省去实例 __dict__；新增配置项时需同步添加到这里
+    __slots__ = (
+        "api_id",
+        "api_hash",
+        "phone",
+        "session_path",
+        "chats",
+        "chat_id",
+        "chat_link",
+        "db_path",
+        "report_dir",
+        "timezone",
+        "last_id_path",
+        "chat_link_cache_path",
+        "pull_days",
+        "send_report_to_me",
+        "enable_ai_summary",
+        "ai_api_base",
+        "ai_api_key",
+        "ai_model",
+        "ai_max_categories",
+        "ai_timeout",
+        "ai_style",
+        "ai_max_messages_per_batch",
+        "ai_concurrency",
+        "ai_stream",
+        "ai_cache_enabled",
+        "ai_cache_dir",
+        "ai_cache_ttl_hours",
+        "ai_semantic_cache_enabled",
+        "ai_semantic_threshold",
+        "ai_semantic_model",
+    )
+    
     def __init__(self, raw: Dict[str, Any]) -> None:
         self.api_id: int = int(raw["api_id"])
         self.api_hash: str = str(raw["api_hash"])
@@ -84,7 +128,6 @@ class Config:
         
         self.db_path: Path = Path(raw.get("db_path", "data/messages.db"))
         self.report_dir: Path = Path(raw.get("report_dir", "reports"))
-        self.media_dir: Path = Path(raw.get("media_dir", "data/media"))
         self.timezone: timezone = timezone.utc
         tz_name = raw.get("timezone")
         if tz_name:
@@ -95,10 +138,12 @@ class Config:
             except Exception as exc:  # pragma: no cover - best effort fallback
                 log.warning("Failed to load timezone %s: %s, fallback to UTC", tz_name, exc)
         self.last_id_path: Path = Path(raw.get("last_id_path", "data/last_id.json"))
+        # chat_link -> chat_id 的解析结果缓存，避免每次运行都请求 Telegram 解析链接
+        self.chat_link_cache_path: Path = Path(
+            raw.get("chat_link_cache_path", self.last_id_path.parent / "chat_links.json")
+        )
         self.pull_days: int = int(raw.get("pull_days", 2))
         self.send_report_to_me: bool = bool(raw.get("send_report_to_me", True))
-        self.download_media: bool = bool(raw.get("download_media", True))
-        self.max_media_mb: int = int(raw.get("max_media_mb", 10))
         self.enable_ai_summary: bool = bool(raw.get("enable_ai_summary", False))
         self.ai_api_base: str = str(raw.get("ai_api_base", "")).strip()
         self.ai_api_key: str = str(raw.get("ai_api_key", "")).strip()
@@ -107,10 +152,21 @@ class Config:
         self.ai_timeout: float = float(raw.get("ai_timeout", 120.0))
         self.ai_style: Optional[str] = str(raw["ai_style"]).strip() if "ai_style" in raw else None
         self.ai_max_messages_per_batch: int = int(raw.get("ai_max_messages_per_batch", 200))
+        # 可选：同时进行的 AI 请求数量（各线程/批次的请求相互独立，可并发发送）
+        self.ai_concurrency: int = int(raw.get("ai_concurrency", 8))
+        # 可选：以流式（SSE）方式接收 AI 响应，边接收边累积，不缓冲整个响应体
+        self.ai_stream: bool = bool(raw.get("ai_stream", False))
+        # 可选：是否缓存 AI 分析结果（相同请求直接读取本地缓存，不重复调用 API）
+        self.ai_cache_enabled: bool = bool(raw.get("ai_cache_enabled", False))
+        self.ai_cache_dir: Path = Path(raw.get("ai_cache_dir", self.db_path.parent / "ai_cache"))
+        # 可选：缓存有效期（小时），超过后重新请求 API 并覆盖缓存；0 或不配置表示永不过期
+        self.ai_cache_ttl_hours: float = float(raw.get("ai_cache_ttl_hours", 0))
+        # 可选：语义缓存（需要 numpy 与 sentence-transformers），近似重复的消息集合复用之前的分析结果
+        self.ai_semantic_cache_enabled: bool = bool(raw.get("ai_semantic_cache_enabled", False))
+        self.ai_semantic_threshold: float = float(raw.get("ai_semantic_threshold", 0.92))
+        self.ai_semantic_model: str = str(raw.get("ai_semantic_model", "all-MiniLM-L6-v2")).strip()
 
 
 def load_config(path: Path) -> Config:
     """从 JSON 文件加载配置"""
-    with path.open("r", encoding="utf-8") as f:
-        raw = json.load(f)
-    return Config(raw)
+    return Config(orjson.loads(path.read_bytes()))
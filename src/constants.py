@@ -11,7 +11,11 @@ TOP_N_USERS = 5  # 显示 Top N 活跃用户
 TOP_N_THREADS = 5  # 显示 Top N 热门回复线程
 TOP_N_MESSAGE_IDS = 5  # 在报告中显示的消息ID数量上限
 
+# 数据库写入相关常量
+INSERT_BATCH_SIZE = 500  # 拉取消息时每批写入数据库的行数
+
 # Telegram 相关常量
+FETCH_CHAT_CONCURRENCY = 4  # 同时拉取消息的群组数量上限
 SUPERGROUP_CHAT_ID_PREFIX = -100  # 超级群组的 chat_id 前缀
 
 # AI 分类优先级常量
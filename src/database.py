@@ -1,15 +1,31 @@
 """数据库模块：处理数据库初始化和 last_id 管理"""
-import json
 import logging
+import os
 import sqlite3
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Iterable, Optional
+
+import orjson
 
 from config import Config
 from constants import TOP_THREAD_ID
 
 log = logging.getLogger(__name__)
 
+# 单条 SQL 中 IN (...) 参数的最大数量（SQLite 旧版本的变量上限为 999）
+MAX_IN_PARAMS = 900
+
+# schema_meta 中记录的迁移标记
+_META_THREAD_ID_BACKFILLED = "thread_id_backfilled"
+_META_DATE_TS_BACKFILLED = "date_ts_backfilled"
+
+# messages 表的索引
+_CREATE_INDEXES = """
+    CREATE INDEX IF NOT EXISTS idx_messages_chat_date_ts ON messages(chat_id, date_ts);
+    CREATE INDEX IF NOT EXISTS idx_messages_reply_to ON messages(chat_id, reply_to);
+    CREATE INDEX IF NOT EXISTS idx_messages_thread_id ON messages(chat_id, thread_id);
+"""
+
 
 def ensure_dirs(cfg: Config) -> None:
     """确保所有必需的目录存在"""
@@ -17,147 +33,288 @@ def ensure_dirs(cfg: Config) -> None:
     cfg.db_path.parent.mkdir(parents=True, exist_ok=True)
     cfg.report_dir.mkdir(parents=True, exist_ok=True)
     cfg.last_id_path.parent.mkdir(parents=True, exist_ok=True)
-    cfg.media_dir.mkdir(parents=True, exist_ok=True)
 
 
-def ensure_db(cfg: Config) -> None:
-    """确保数据库表存在，并执行必要的迁移"""
-    conn = sqlite3.connect(cfg.db_path)
+def open_db(cfg: Config) -> sqlite3.Connection:
+    """
+    打开数据库连接并应用性能相关的 PRAGMA
+    
+    - WAL 日志模式：写入时不阻塞读取，提交只需追加 WAL 文件
+    - synchronous=NORMAL：WAL 模式下仍然安全，且避免每次提交都 fsync
+    - 临时表/排序放在内存，扩大页缓存并启用 mmap
+    - busy_timeout：数据库被其他连接锁定时等待最多 5 秒，而不是立即报错
+    - row_factory 在连接级别设置一次，查询结果统一为 sqlite3.Row
+    - check_same_thread=False：拉取消息时写入在专用线程中执行（同一时刻只有一个线程使用连接）
+    
+    Args:
+        cfg: 配置对象
+    
+    Returns:
+        已配置的数据库连接
+    """
+    conn = sqlite3.connect(cfg.db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _get_meta(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    """读取 schema_meta 中的迁移状态，不存在时返回 None"""
+    row = conn.execute("SELECT value FROM schema_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(conn: sqlite3.Connection, key: str, value: str) -> None:
+    """写入 schema_meta 中的迁移状态"""
+    conn.execute(
+        "INSERT INTO schema_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value),
+    )
+
+
+def _has_stats(conn: sqlite3.Connection, table: str) -> bool:
+    """表在 sqlite_stat1 中是否已有统计信息（从未执行过 ANALYZE 时 sqlite_stat1 不存在）"""
     try:
+        return conn.execute("SELECT 1 FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (table,)).fetchone() is not None
+    except sqlite3.OperationalError:
+        return False
+
+
+def _add_column(conn: sqlite3.Connection, ddl: str) -> bool:
+    """
+    执行 ALTER TABLE ... ADD COLUMN，列已存在时忽略
+    
+    Returns:
+        True 表示本次新增了该列，False 表示列已存在
+    """
+    try:
+        conn.execute(ddl)
+    except sqlite3.OperationalError as exc:
+        if "duplicate column name" in str(exc):
+            return False
+        raise
+    return True
+
+
+def ensure_db(conn: sqlite3.Connection) -> None:
+    """
+    确保数据库表存在，并执行必要的迁移
+    
+    Args:
+        conn: 数据库连接（由 open_db 打开，调用方负责关闭）
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            user_id INTEGER,
+            username TEXT,
+            text TEXT,
+            media_type TEXT,
+            file_id TEXT,
+            reply_to INTEGER,
+            date TEXT NOT NULL,
+            file_path TEXT,
+            thread_id INTEGER,
+            date_ts INTEGER,
+            PRIMARY KEY (chat_id, message_id)
+        );
+        """
+    )
+    # 迁移状态表：记录已完成的一次性迁移
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_meta (key TEXT PRIMARY KEY, value TEXT);")
+    # Migration: ensure file_path column exists
+    _add_column(conn, "ALTER TABLE messages ADD COLUMN file_path TEXT;")
+    # Migration: ensure thread_id column exists and populate it
+    if _add_column(conn, "ALTER TABLE messages ADD COLUMN thread_id INTEGER;"):
+        # 根据 reply_to 字段进行分类：
+        # - 如果 reply_to 不为 NULL，则 thread_id = reply_to（属于回复该消息的线程）
+        # - 如果 reply_to 为 NULL，则 thread_id = TOP_THREAD_ID（顶层消息，统一归类）
         conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS messages (
-                chat_id INTEGER NOT NULL,
-                message_id INTEGER NOT NULL,
-                user_id INTEGER,
-                username TEXT,
-                text TEXT,
-                media_type TEXT,
-                file_id TEXT,
-                reply_to INTEGER,
-                date TEXT NOT NULL,
-                file_path TEXT,
-                thread_id INTEGER,
-                PRIMARY KEY (chat_id, message_id)
-            );
+            UPDATE messages
+            SET thread_id = CASE
+                WHEN reply_to IS NOT NULL THEN reply_to
+                ELSE ?
+            END
+            """,
+            (TOP_THREAD_ID,),
+        )
+        _set_meta(conn, _META_THREAD_ID_BACKFILLED, "1")
+        conn.commit()
+        log.info("Added thread_id column and populated based on reply_to classification")
+    elif _get_meta(conn, _META_THREAD_ID_BACKFILLED) is None:
+        # Migration: update existing records where reply_to is NULL to use thread_id = TOP_THREAD_ID
+        # 只需执行一次，完成后记录到 schema_meta，避免每次启动都扫描全表
+        cur = conn.execute(
             """
+            UPDATE messages
+            SET thread_id = ?
+            WHERE reply_to IS NULL AND thread_id != ?
+            """,
+            (TOP_THREAD_ID, TOP_THREAD_ID),
+        )
+        updated = cur.rowcount
+        _set_meta(conn, _META_THREAD_ID_BACKFILLED, "1")
+        conn.commit()
+        if updated > 0:
+            log.info("Updated %s messages without reply_to to thread_id=%s", updated, TOP_THREAD_ID)
+    # Migration: ensure date_ts column exists and populate it
+    # date_ts 为消息时间的 UNIX 时间戳（秒），按日期范围查询时用整数比较，索引也更小
+    if _add_column(conn, "ALTER TABLE messages ADD COLUMN date_ts INTEGER;") or (
+        _get_meta(conn, _META_DATE_TS_BACKFILLED) is None
+    ):
+        cur = conn.execute(
+            "UPDATE messages SET date_ts = CAST(strftime('%s', date) AS INTEGER) WHERE date_ts IS NULL"
         )
-        # Migration: ensure file_path column exists
-        cols = {row[1] for row in conn.execute("PRAGMA table_info(messages)").fetchall()}
-        if "file_path" not in cols:
-            conn.execute("ALTER TABLE messages ADD COLUMN file_path TEXT;")
-        # Migration: ensure thread_id column exists and populate it
-        if "thread_id" not in cols:
-            conn.execute("ALTER TABLE messages ADD COLUMN thread_id INTEGER;")
-            # 根据 reply_to 字段进行分类：
-            # - 如果 reply_to 不为 NULL，则 thread_id = reply_to（属于回复该消息的线程）
-            # - 如果 reply_to 为 NULL，则 thread_id = TOP_THREAD_ID（顶层消息，统一归类）
-            conn.execute(
-                """
-                UPDATE messages
-                SET thread_id = CASE
-                    WHEN reply_to IS NOT NULL THEN reply_to
-                    ELSE ?
-                END
-                """,
-                (TOP_THREAD_ID,),
-            )
-            conn.commit()
-            log.info("Added thread_id column and populated based on reply_to classification")
-        else:
-            # Migration: update existing records where reply_to is NULL to use thread_id = TOP_THREAD_ID
-            conn.execute(
-                """
-                UPDATE messages
-                SET thread_id = ?
-                WHERE reply_to IS NULL AND thread_id != ?
-                """,
-                (TOP_THREAD_ID, TOP_THREAD_ID),
-            )
-            conn.commit()
-            updated = conn.execute("SELECT changes()").fetchone()[0]
-            if updated > 0:
-                log.info("Updated %s messages without reply_to to thread_id=%s", updated, TOP_THREAD_ID)
-        
-        # 创建索引以优化 reply_to 查询性能
-        # 检查索引是否已存在
-        indexes = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'").fetchall()]
-        if "idx_messages_reply_to" not in indexes:
-            conn.execute("CREATE INDEX idx_messages_reply_to ON messages(chat_id, reply_to)")
-            log.info("Created index idx_messages_reply_to for reply_to queries")
-        if "idx_messages_thread_id" not in indexes:
-            conn.execute("CREATE INDEX idx_messages_thread_id ON messages(chat_id, thread_id)")
-            log.info("Created index idx_messages_thread_id for thread_id queries")
-        
+        _set_meta(conn, _META_DATE_TS_BACKFILLED, "1")
         conn.commit()
-    finally:
-        conn.close()
+        if cur.rowcount > 0:
+            log.info("Populated date_ts for %s existing messages", cur.rowcount)
+    
+    # 创建索引以优化按日期范围取消息（生成报告）以及 reply_to / thread_id 查询性能（IF NOT EXISTS 由 SQLite 自行判断，无需先查询 sqlite_master）
+    conn.executescript(_CREATE_INDEXES)
+    # messages 还没有统计信息时（新建索引或上次分析时表为空）收集一次，让查询优化器选用索引；
+    # 之后随数据增长的统计更新由关闭连接前的 PRAGMA optimize 负责
+    if not _has_stats(conn, "messages"):
+        conn.execute("ANALYZE messages")
+    
+    conn.commit()
 
 
-def get_replied_message(conn: sqlite3.Connection, chat_id: int, message_id: int) -> Optional[sqlite3.Row]:
+def get_replied_messages(
+    conn: sqlite3.Connection, chat_id: int, message_ids: Iterable[int]
+) -> Dict[int, sqlite3.Row]:
     """
-    查询被回复的消息详情
+    批量查询被回复的消息详情（按 MAX_IN_PARAMS 分段的 IN 查询）
     
     Args:
-        conn: 数据库连接
+        conn: 数据库连接（由 open_db 打开，row_factory 为 sqlite3.Row）
         chat_id: 群组ID
-        message_id: 消息ID（被回复的消息ID）
+        message_ids: 消息ID集合（被回复的消息ID）
     
     Returns:
-        被回复的消息行，如果不存在则返回 None
+        消息ID到消息行的映射，不存在的消息不会出现在结果中
     """
-    conn.row_factory = sqlite3.Row
-    cur = conn.execute(
-        """
-        SELECT message_id, user_id, username, text, media_type, date
-        FROM messages
-        WHERE chat_id = ? AND message_id = ?
-        """,
-        (chat_id, message_id),
-    )
-    return cur.fetchone()
+    ids = list(dict.fromkeys(message_ids))
+    result: Dict[int, sqlite3.Row] = {}
+    for start in range(0, len(ids), MAX_IN_PARAMS):
+        chunk = ids[start:start + MAX_IN_PARAMS]
+        placeholders = ",".join("?" * len(chunk))
+        cur = conn.execute(
+            f"""
+            SELECT message_id, user_id, username, text, media_type, date
+            FROM messages
+            WHERE chat_id = ? AND message_id IN ({placeholders})
+            """,
+            (chat_id, *chunk),
+        )
+        for row in cur:
+            result[row["message_id"]] = row
+    return result
 
 
-def get_last_id(cfg: Config, chat_id: int) -> int:
-    """获取指定群组的 last_id"""
-    if not cfg.last_id_path.exists():
-        # 尝试迁移旧的 last_id.txt 文件
-        old_path = cfg.last_id_path.parent / "last_id.txt"
-        if old_path.exists():
-            try:
-                old_value = int(old_path.read_text().strip() or "0")
-                # 迁移到新格式
-                data = {str(cfg.chat_id): old_value}
-                cfg.last_id_path.write_text(json.dumps(data, indent=2), encoding="utf-8")
-                log.info("Migrated last_id.txt to last_id.json for chat_id %s", cfg.chat_id)
-                return old_value
-            except (ValueError, KeyError):
-                pass
-        return 0
-    try:
-        data = json.loads(cfg.last_id_path.read_text(encoding="utf-8"))
-        # 支持旧格式（单个数字）和新格式（JSON 对象）
-        if isinstance(data, dict):
-            return int(data.get(str(chat_id), 0))
-        else:
+def _write_json_atomic(path: Path, data: Dict[str, int]) -> None:
+    """先写临时文件再 os.replace 替换，避免写入中途崩溃导致文件损坏"""
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, path)
+
+
+class LastIdStore:
+    """
+    last_id 的内存存储：一次运行中只读取、解析 last_id.json 一次，
+    get/set 均在内存字典上完成，flush() 时原子写回文件。
+    
+    兼容旧格式：last_id.txt 或 last_id.json 中的单个数字，均视为第一个群组（cfg.chat_id）的值。
+    """
+    
+    def __init__(self, cfg: Config) -> None:
+        self._path: Path = cfg.last_id_path
+        self._dirty = False
+        self._data: Dict[str, int] = self._load(cfg)
+    
+    def _load(self, cfg: Config) -> Dict[str, int]:
+        if not self._path.exists():
+            # 尝试迁移旧的 last_id.txt 文件
+            old_path = self._path.parent / "last_id.txt"
+            if old_path.exists():
+                try:
+                    old_value = int(old_path.read_text().strip() or "0")
+                except ValueError:
+                    return {}
+                # 迁移到新格式，下次 flush 时写入 last_id.json
+                self._dirty = True
+                log.info("Migrating last_id.txt to last_id.json for chat_id %s", cfg.chat_id)
+                return {str(cfg.chat_id): old_value}
+            return {}
+        try:
+            data = orjson.loads(self._path.read_bytes())
+            # 支持旧格式（单个数字）和新格式（JSON 对象）
+            if isinstance(data, dict):
+                return {str(k): int(v) for k, v in data.items()}
             # 旧格式：单个数字，只对第一个群组有效
-            return int(data) if chat_id == cfg.chat_id else 0
-    except (json.JSONDecodeError, ValueError, KeyError):
-        return 0
+            self._dirty = True
+            return {str(cfg.chat_id): int(data)}
+        except (orjson.JSONDecodeError, ValueError, TypeError):
+            return {}
+    
+    def get(self, chat_id: int) -> int:
+        """获取指定群组的 last_id，未记录时返回 0"""
+        return self._data.get(str(chat_id), 0)
+    
+    def set(self, chat_id: int, value: int) -> None:
+        """设置指定群组的 last_id（仅更新内存，调用 flush 后才写入文件）"""
+        if self._data.get(str(chat_id)) == value:
+            return
+        self._data[str(chat_id)] = value
+        self._dirty = True
+    
+    def flush(self) -> None:
+        """如有变更，将 last_id 原子写回文件"""
+        if not self._dirty:
+            return
+        _write_json_atomic(self._path, self._data)
+        self._dirty = False
+
+
+def load_chat_link_cache(cfg: Config) -> Dict[str, int]:
+    """
+    读取 chat_link -> chat_id 的解析缓存
+    
+    Returns:
+        链接到 chat_id 的映射，文件不存在或损坏时返回空字典
+    """
+    path = cfg.chat_link_cache_path
+    if not path.exists():
+        return {}
+    try:
+        data = orjson.loads(path.read_bytes())
+        return {str(k): int(v) for k, v in data.items()}
+    except (orjson.JSONDecodeError, AttributeError, ValueError, TypeError):
+        log.warning("Ignoring invalid chat link cache %s", path)
+        return {}
+
+
+def save_chat_link_cache(cfg: Config, data: Dict[str, int]) -> None:
+    """原子写入 chat_link -> chat_id 的解析缓存"""
+    cfg.chat_link_cache_path.parent.mkdir(parents=True, exist_ok=True)
+    _write_json_atomic(cfg.chat_link_cache_path, data)
+
+
+def get_last_id(cfg: Config, chat_id: int) -> int:
+    """获取指定群组的 last_id（已弃用：每次调用都会重新读取文件，请使用 LastIdStore）"""
+    return LastIdStore(cfg).get(chat_id)
 
 
 def set_last_id(cfg: Config, chat_id: int, value: int) -> None:
-    """设置指定群组的 last_id"""
-    data: Dict[str, int] = {}
-    if cfg.last_id_path.exists():
-        try:
-            existing = json.loads(cfg.last_id_path.read_text(encoding="utf-8"))
-            if isinstance(existing, dict):
-                data = existing
-            else:
-                # 迁移旧格式
-                data = {str(cfg.chat_id): int(existing)}
-        except (json.JSONDecodeError, ValueError):
-            pass
-    data[str(chat_id)] = value
-    cfg.last_id_path.write_text(json.dumps(data, indent=2), encoding="utf-8")
+    """设置指定群组的 last_id（已弃用：每次调用都会读写整个文件，请使用 LastIdStore）"""
+    store = LastIdStore(cfg)
+    store.set(chat_id, value)
+    store.flush()
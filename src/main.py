@@ -1,22 +1,31 @@
 import argparse
+import asyncio
 import json
 import logging
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from telethon import TelegramClient
 
+from ai_client import close_client
 from config import ChatConfig, Config, load_config
-from constants import TOP_THREAD_ID
-from database import ensure_dirs, ensure_db, get_last_id, set_last_id
-from message_handler import (
-    build_media_path,
-    extract_media,
-    is_video_or_voice,
-    normalize_dt,
+from constants import (
+    FETCH_CHAT_CONCURRENCY,
+    INSERT_BATCH_SIZE,
+    TOP_THREAD_ID,
 )
+from database import (
+    LastIdStore,
+    ensure_db,
+    ensure_dirs,
+    load_chat_link_cache,
+    open_db,
+    save_chat_link_cache,
+)
+from message_handler import extract_media
 from report_generator import generate_report
 
 
@@ -54,10 +63,7 @@ async def get_chat_id_from_link(client: TelegramClient, chat_link: str) -> int:
 
 
 async def init_session(client: TelegramClient, cfg: Config) -> None:
-    await client.connect()
-    if await client.is_user_authorized():
-        log.info("Session already authorized.")
-        return
+    """登录并保存会话（调用方已连接且确认尚未授权）"""
     log.info("Authorizing session for %s ...", cfg.phone)
     await client.send_code_request(cfg.phone)
     code = input("Enter the code you received: ")
@@ -65,35 +71,116 @@ async def init_session(client: TelegramClient, cfg: Config) -> None:
     log.info("Session saved to %s", cfg.session_path)
 
 
+# 消息插入语句：模块级常量，保证 sqlite3 的语句缓存每次都能命中，只需解析一次
+_INSERT_SQL = """
+    INSERT OR IGNORE INTO messages
+    (chat_id, message_id, user_id, username, text, media_type, file_id, reply_to, date, file_path, thread_id, date_ts)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def _row_from_msg(
+    msg: Any,
+    username: Optional[str],
+    media_type: Optional[str],
+    file_id: Optional[str],
+    reply_to: Optional[int],
+    date_iso: str,
+    thread_id: int,
+    date_ts: int,
+) -> Tuple[Any, ...]:
+    """
+    构建一条待插入的消息行（列顺序与 _INSERT_SQL 一致）
+    
+    含媒体的消息在拉取时已被跳过，file_path 统一为 NULL。
+    """
+    return (
+        msg.chat_id,
+        msg.id,
+        msg.sender_id,
+        username,
+        msg.message or "",
+        media_type,
+        file_id,
+        reply_to,
+        date_iso,
+        None,
+        thread_id,
+        date_ts,
+    )
+
+
+class _MessageWriter:
+    """
+    拉取消息时的数据库写入器：所有写操作都在一个专用线程中串行执行，不阻塞事件循环
+    
+    多个群组并发拉取时共用同一个写入器（同一个连接），单线程执行器保证写入不会交错。
+    executemany 在同一个事务内完成整批插入（sqlite3 在第一条 INSERT 前隐式 BEGIN），
+    每批只提交一次；批量导入模式下不做中间提交，由调用方在拉取结束后统一提交。
+    """
+    
+    def __init__(self, conn: sqlite3.Connection, bulk_load: bool = False) -> None:
+        self._conn = conn
+        self._commit = not bulk_load
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+    
+    async def _run(self, func: Callable[..., None], *args: Any) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+    
+    def _insert(self, rows: List[Tuple[Any, ...]]) -> None:
+        self._conn.executemany(_INSERT_SQL, rows)
+        if self._commit:
+            self._conn.commit()
+    
+    async def insert(self, rows: List[Tuple[Any, ...]]) -> None:
+        """批量写入消息行（列顺序与 _INSERT_SQL 一致）"""
+        if rows:
+            await self._run(self._insert, rows)
+    
+    def close(self) -> None:
+        """等待已提交的写操作完成并关闭写入线程"""
+        self._executor.shutdown(wait=True)
+
+
 async def fetch_incremental_for_chat(
     client: TelegramClient,
     cfg: Config,
     chat_config: ChatConfig,
-    conn: sqlite3.Connection,
+    writer: _MessageWriter,
+    last_ids: LastIdStore,
 ) -> None:
     """为单个群组拉取增量消息"""
     chat_id = chat_config.chat_id
     chat_name = chat_config.name or f"chat_{chat_id}"
-    last_id = get_last_id(cfg, chat_id)
+    last_id = last_ids.get(chat_id)
     now_cfg = datetime.now(tz=cfg.timezone)
     cutoff = now_cfg - timedelta(days=cfg.pull_days)
     inserted = 0
     skipped_by_time = 0
     max_id = last_id
+    # 待写入的消息行，攒够 INSERT_BATCH_SIZE 条后批量写入
+    pending: List[Tuple[Any, ...]] = []
+    # sender_id -> username 缓存
+    sender_usernames: Dict[Optional[int], Optional[str]] = {}
     
     # 记录时间范围信息用于排查
     cutoff_utc = cutoff.astimezone(timezone.utc)
+    cutoff_ts = cutoff.timestamp()
+    cutoff_iso = cutoff.isoformat()
     now_utc = now_cfg.astimezone(timezone.utc)
     tz_name = getattr(cfg.timezone, "key", None) or str(cfg.timezone)
     log.info("Fetching messages for %s (chat_id: %s, last_id: %s)", chat_name, chat_id, last_id)
     log.info("Time range: now=%s (%s), cutoff=%s (%s), pull_days=%d", 
-             now_cfg.isoformat(), tz_name, cutoff.isoformat(), tz_name, cfg.pull_days)
+             now_cfg.isoformat(), tz_name, cutoff_iso, tz_name, cfg.pull_days)
     log.info("Time range (UTC): now=%s, cutoff=%s", now_utc.isoformat(), cutoff_utc.isoformat())
     
     try:
+        # 首次拉取（没有 last_id）时用 offset_date 让服务端直接从截止时间开始返回，
+        # 不再分页拉取截止时间之前的全部历史消息；reverse=True 时 offset_date 表示起始时间
         async for msg in client.iter_messages(
             chat_id,
             min_id=last_id,
+            offset_date=cutoff if last_id == 0 else None,
             reverse=True,
         ):
             if msg is None:
@@ -102,32 +189,24 @@ async def fetch_incremental_for_chat(
                 continue
             # 记录原始消息时间的时区信息
             msg_date_original = msg.date
-            msg_dt = normalize_dt(msg.date, cfg.timezone)
-            if msg_dt < cutoff:
+            # Telethon 返回的 msg.date 实际总是 UTC aware；个别无时区信息的按 UTC 处理
+            if msg_date_original.tzinfo is None:
+                msg_date_original = msg_date_original.replace(tzinfo=timezone.utc)
+            # 用时间戳与截止时间比较，避免对被过滤的消息做时区转换
+            msg_ts = msg_date_original.timestamp()
+            if msg_ts < cutoff_ts:
                 skipped_by_time += 1
                 # 只记录前几条被过滤的消息，避免日志过多
                 if skipped_by_time <= 3:
-                    msg_utc = msg_date_original.astimezone(timezone.utc) if msg_date_original.tzinfo else msg_date_original.replace(tzinfo=timezone.utc)
                     log.debug("Skipped message %s: date=%s (UTC: %s, %s: %s) < cutoff=%s (%s)", 
-                             msg.id, msg_date_original, msg_utc.isoformat(), tz_name, msg_dt.isoformat(), 
-                             cutoff.isoformat(), tz_name)
+                             msg.id, msg_date_original, msg_date_original.astimezone(timezone.utc).isoformat(),
+                             tz_name, msg_date_original.astimezone(cfg.timezone).isoformat(), 
+                             cutoff_iso, tz_name)
                 continue
             media_type, file_id = extract_media(msg.media)
-            # 忽略所有 media_type 不为空的消息
+            # 忽略所有 media_type 不为空的消息（媒体消息不入库，也不下载）
             if media_type is not None:
                 continue
-            file_path: Optional[Path] = None
-            if cfg.download_media and media_type and not is_video_or_voice(msg):
-                size = getattr(msg.file, "size", None) if getattr(msg, "file", None) else None
-                if size is not None and size <= cfg.max_media_mb * 1024 * 1024:
-                    target = build_media_path(msg, cfg)
-                    try:
-                        await client.download_media(msg, file=target)
-                        file_path = target
-                    except Exception as exc:
-                        log.warning("Download failed for msg %s: %s", msg.id, exc)
-                else:
-                    log.debug("Skip media download for msg %s due to size or unknown", msg.id)
             # 提取 reply_to 字段：处理回复消息的情况
             # Telethon 的 reply_to 可能是 MessageReplyHeader 对象
             reply_to = None
@@ -148,54 +227,83 @@ async def fetch_incremental_for_chat(
                 thread_id = reply_to if reply_to is not None else TOP_THREAD_ID
             else:
                 thread_id = TOP_THREAD_ID
-            text = msg.message or ""
-            conn.execute(
-                """
-                INSERT OR IGNORE INTO messages
-                (chat_id, message_id, user_id, username, text, media_type, file_id, reply_to, date, file_path, thread_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    msg.chat_id,
-                    msg.id,
-                    msg.sender_id,
-                    getattr(msg.sender, "username", None) if msg.sender else None,
-                    text,
-                    media_type,
-                    file_id,
-                    reply_to,
-                    msg_dt.isoformat(),
-                    str(file_path) if file_path else None,
-                    thread_id,
-                ),
+            # 同一发送者的用户名只从 Telethon 实体取一次
+            sender_id = msg.sender_id
+            if sender_id in sender_usernames:
+                username = sender_usernames[sender_id]
+            else:
+                username = getattr(msg.sender, "username", None)
+                sender_usernames[sender_id] = username
+            # 只对通过截止时间过滤的消息做时区转换和格式化
+            # msg_date_original 已保证带时区信息，直接转换即可
+            msg_dt = msg_date_original.astimezone(cfg.timezone)
+            pending.append(
+                _row_from_msg(msg, username, media_type, file_id, reply_to, msg_dt.isoformat(), thread_id, int(msg_ts))
             )
+            if len(pending) >= INSERT_BATCH_SIZE:
+                await writer.insert(pending)
+                pending = []
             inserted += 1
-            if msg.id > max_id:
-                max_id = msg.id
+            # reverse=True 按 id 升序返回（且 min_id 保证 id > last_id），最后写入的即为最大 id
+            max_id = msg.id
+        await writer.insert(pending)
     except Exception as exc:
         log.error("Error fetching messages for %s (chat_id: %s): %s", chat_name, chat_id, exc)
         raise
 
     if max_id != last_id:
-        set_last_id(cfg, chat_id, max_id)
+        last_ids.set(chat_id, max_id)
     log.info("Pulled %s new messages for %s (chat_id: %s, last_id %s -> %s, skipped_by_time: %s)", 
              inserted, chat_name, chat_id, last_id, max_id, skipped_by_time)
 
 
-async def fetch_incremental(client: TelegramClient, cfg: Config) -> None:
-    """为所有配置的群组拉取增量消息"""
+async def fetch_incremental(
+    client: TelegramClient, cfg: Config, conn: sqlite3.Connection, bulk_load: bool = False
+) -> None:
+    """
+    为所有配置的群组拉取增量消息
+    
+    Args:
+        client: TelegramClient 实例
+        cfg: 配置对象
+        conn: 数据库连接
+        bulk_load: 批量导入模式（适合首次拉取大量历史消息）：拉取期间关闭 fsync（synchronous=OFF），
+            所有写入放在一个事务中最后统一提交，完成后恢复 synchronous=NORMAL 并执行 ANALYZE
+    """
     if not cfg.chats:
         log.warning("No chats configured. Nothing to fetch.")
         return
     
-    conn = sqlite3.connect(cfg.db_path)
-    conn.row_factory = sqlite3.Row
+    last_ids = LastIdStore(cfg)
+    # 多个群组并发拉取，用信号量限制同时进行的数量；所有群组共用一个写入器
+    sem = asyncio.Semaphore(FETCH_CHAT_CONCURRENCY)
+    
+    # 数据库写入交给专用线程执行，避免阻塞 Telethon 的网络读写
+    writer = _MessageWriter(conn, bulk_load)
+    
+    async def fetch_one(chat_config: ChatConfig) -> None:
+        async with sem:
+            await fetch_incremental_for_chat(client, cfg, chat_config, writer, last_ids)
+    
+    if bulk_load:
+        conn.execute("PRAGMA synchronous=OFF")
     try:
-        for chat_config in cfg.chats:
-            await fetch_incremental_for_chat(client, cfg, chat_config, conn)
+        results = await asyncio.gather(*(fetch_one(c) for c in cfg.chats), return_exceptions=True)
+        # 每次写入都已 await 完成，此时写入线程已空闲，可以在当前线程提交
         conn.commit()
     finally:
-        conn.close()
+        writer.close()
+        if bulk_load:
+            conn.execute("PRAGMA synchronous=NORMAL")
+    if bulk_load:
+        # 大量写入后更新查询优化器的统计信息
+        conn.execute("ANALYZE")
+    # 消息提交后再持久化 last_id，避免记录了未落库的消息；
+    # 失败群组的 last_id 不会被更新，成功群组的进度照常保存
+    last_ids.flush()
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        raise errors[0]
 
 
 
@@ -206,10 +314,15 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--init-session", action="store_true", help="Authorize session")
     parser.add_argument("--pull", action="store_true", help="Pull incremental messages")
     parser.add_argument("--report", action="store_true", help="Generate daily report for today")
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help="Faster first-time pull: disable fsync and commit once at the end (not crash-safe)",
+    )
     return parser.parse_args()
 
 
-def _validate_and_resolve_chats(client: TelegramClient, cfg: Config) -> None:
+async def _validate_and_resolve_chats(client: TelegramClient, cfg: Config) -> None:
     """
     验证并解析所有群组的 chat_id
     
@@ -223,14 +336,19 @@ def _validate_and_resolve_chats(client: TelegramClient, cfg: Config) -> None:
     if not cfg.chats:
         raise ValueError("No chats configured. Please configure at least one chat in config.json")
     
+    link_cache = load_chat_link_cache(cfg)
+    pending: List[ChatConfig] = []
     for chat_config in cfg.chats:
-        # 如果配置了 chat_link，从链接获取 chat_id
+        # 如果配置了 chat_link，从链接获取 chat_id（优先使用之前解析过的缓存结果）
         if chat_config.chat_link:
             if not chat_config.chat_id or chat_config.chat_id == 0:
-                log.info("Resolving chat_id from chat_link: %s", chat_config.chat_link)
-                chat_config.chat_id = client.loop.run_until_complete(
-                    get_chat_id_from_link(client, chat_config.chat_link)
-                )
+                cached_id = link_cache.get(chat_config.chat_link)
+                if cached_id:
+                    log.info("Using cached chat_id %s for chat_link: %s", cached_id, chat_config.chat_link)
+                    chat_config.chat_id = cached_id
+                else:
+                    log.info("Resolving chat_id from chat_link: %s", chat_config.chat_link)
+                    pending.append(chat_config)
             else:
                 log.info("Both chat_link and chat_id are configured for %s. Using chat_id: %s", 
                          chat_config.name or "chat", chat_config.chat_id)
@@ -239,87 +357,133 @@ def _validate_and_resolve_chats(client: TelegramClient, cfg: Config) -> None:
                 f"Either chat_id or chat_link must be configured for chat: {chat_config.name or 'unnamed'}"
             )
     
+    # 在同一个客户端连接上并发解析所有需要解析的链接
+    if pending:
+        chat_ids = await asyncio.gather(*(get_chat_id_from_link(client, c.chat_link) for c in pending))
+        for chat_config, chat_id in zip(pending, chat_ids):
+            chat_config.chat_id = chat_id
+            link_cache[chat_config.chat_link] = chat_id
+        save_chat_link_cache(cfg, link_cache)
+    
     # 更新向后兼容的单个 chat_id（用于旧代码）
     if cfg.chats:
         cfg.chat_id = cfg.chats[0].chat_id
         cfg.chat_link = cfg.chats[0].chat_link
 
 
-def _generate_all_reports(client: TelegramClient, cfg: Config) -> None:
+async def _generate_all_reports(client: TelegramClient, cfg: Config, conn: sqlite3.Connection) -> None:
     """
     为所有配置的群组生成报告
     
     Args:
         client: TelegramClient 实例
         cfg: 配置对象
+        conn: 数据库连接
     """
-    conn = sqlite3.connect(cfg.db_path)
-    try:
-        now_cfg = datetime.now(tz=cfg.timezone)
-        today = now_cfg.date()
-        day_start = datetime.combine(today, datetime.min.time(), tzinfo=cfg.timezone)
-        tz_name = getattr(cfg.timezone, "key", None) or str(cfg.timezone)
-        log.info("Generating reports for date: %s (%s), day_start: %s", 
-                 today.isoformat(), tz_name, day_start.isoformat())
-        all_reports: List[str] = []
-        
-        # 为每个群组生成报告
-        for chat_config in cfg.chats:
-            report_text = generate_report(
-                conn,
-                cfg,
-                day_start,
-                chat_config.chat_id,
-                chat_config.name,
-                chat_config.chat_type,
-                chat_config.chat_link,
-                chat_config.min_thread_messages,
-            )
-            if report_text.strip():
-                all_reports.append(report_text)
-    finally:
-        conn.close()
+    now_cfg = datetime.now(tz=cfg.timezone)
+    today = now_cfg.date()
+    day_start = datetime.combine(today, datetime.min.time(), tzinfo=cfg.timezone)
+    tz_name = getattr(cfg.timezone, "key", None) or str(cfg.timezone)
+    log.info("Generating reports for date: %s (%s), day_start: %s", 
+             today.isoformat(), tz_name, day_start.isoformat())
+    report_paths: List[Path] = []
     
-    # 如果配置了发送报告，将所有报告合并发送
-    if cfg.send_report_to_me and all_reports:
-        combined_report = "\n\n---\n\n".join(all_reports)
-        client.loop.run_until_complete(
-            client.send_message("me", combined_report, parse_mode="md")
+    # 为每个群组生成报告（报告直接写入文件）
+    for chat_config in cfg.chats:
+        report_path = generate_report(
+            conn,
+            cfg,
+            day_start,
+            chat_config.chat_id,
+            chat_config.name,
+            chat_config.chat_type,
+            chat_config.chat_link,
+            chat_config.min_thread_messages,
         )
+        report_paths.append(report_path)
+    
+    # 如果配置了发送报告，从文件读回各报告并合并发送；不发送时报告内容无需进入内存
+    if not cfg.send_report_to_me:
+        return
+    all_reports = [text for text in (path.read_text(encoding="utf-8") for path in report_paths) if text.strip()]
+    if all_reports:
+        combined_report = "\n\n---\n\n".join(all_reports)
+        await client.send_message("me", combined_report, parse_mode="md")
 
 
-def main() -> None:
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-    )
-    args = parse_args()
-    cfg = load_config(Path(args.config))
-    ensure_dirs(cfg)
-    ensure_db(cfg)
-
-    if not any([args.init_session, args.pull, args.report]):
-        log.info("Nothing to do. Use --init-session / --pull / --report.")
+def _install_uvloop() -> None:
+    """如已安装 uvloop（可选依赖），用它替换默认事件循环；必须在创建 TelegramClient 之前调用"""
+    try:
+        import uvloop
+    except ImportError:
         return
+    uvloop.install()
+    log.debug("Using uvloop event loop")
+
 
-    with build_client(cfg) as client:
-        client.loop.run_until_complete(client.connect())
+async def run(cfg: Config, args: argparse.Namespace, conn: sqlite3.Connection) -> None:
+    """
+    在同一个事件循环中完成连接、授权检查、拉取和生成报告
+    
+    只连接一次、只检查一次授权状态。
+    
+    Args:
+        cfg: 配置对象
+        args: 命令行参数
+        conn: 数据库连接
+    """
+    client = build_client(cfg)
+    await client.connect()
+    try:
+        authorized = await client.is_user_authorized()
         if args.init_session:
-            client.loop.run_until_complete(init_session(client, cfg))
+            if authorized:
+                log.info("Session already authorized.")
+            else:
+                await init_session(client, cfg)
+                authorized = True
             if not (args.pull or args.report):
                 return
 
-        if not client.loop.run_until_complete(client.is_user_authorized()):
+        if not authorized:
             raise RuntimeError("Session not authorized. Run with --init-session first.")
 
         # 验证并解析所有群组的 chat_id
-        _validate_and_resolve_chats(client, cfg)
+        await _validate_and_resolve_chats(client, cfg)
 
         if args.pull:
-            client.loop.run_until_complete(fetch_incremental(client, cfg))
+            await fetch_incremental(client, cfg, conn, args.bulk_load)
 
         if args.report:
-            _generate_all_reports(client, cfg)
+            await _generate_all_reports(client, cfg, conn)
+    finally:
+        await client.disconnect()
+
+
+def main() -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+    _install_uvloop()
+    args = parse_args()
+    cfg = load_config(Path(args.config))
+    ensure_dirs(cfg)
+    # 整个运行期间共用一个数据库连接：PRAGMA 只执行一次，拉取后生成报告时页缓存仍然有效
+    conn = open_db(cfg)
+    try:
+        ensure_db(conn)
+
+        if not any([args.init_session, args.pull, args.report]):
+            log.info("Nothing to do. Use --init-session / --pull / --report.")
+            return
+
+        asyncio.run(run(cfg, args, conn))
+    finally:
+        # 按需更新统计信息（只分析统计过期的表），数据增长后查询计划不会沿用旧统计
+        conn.execute("PRAGMA optimize")
+        conn.close()
+        close_client()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,17 @@
 """报告生成模块：生成日报和 AI 摘要"""
 import logging
+import os
 import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from itertools import islice
+from operator import itemgetter
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from string import Template
+from typing import Any, DefaultDict, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
 
+from ai_cache import SemanticCache, get_semantic_cache
 from ai_client import AISummaryError, call_chat_analysis
 from config import Config
 from constants import (
@@ -16,129 +23,200 @@ from constants import (
     TOP_N_USERS,
     TOP_THREAD_ID,
 )
-from database import get_replied_message
+from database import get_replied_messages
 from message_handler import format_user
 
 log = logging.getLogger(__name__)
 
 
-def _calculate_statistics(rows: List[sqlite3.Row]) -> Tuple[Dict[str, int], Dict[str, int], Dict[int, int]]:
+def _semantic_cache(cfg: Config) -> Optional[SemanticCache]:
+    """按配置获取语义缓存实例，未启用时返回 None"""
+    if not cfg.ai_semantic_cache_enabled:
+        return None
+    return get_semantic_cache(cfg.ai_cache_dir / "semantic", cfg.ai_semantic_threshold, cfg.ai_semantic_model)
+
+
+# AI 摘要使用的当天消息行：以 tuple 形式读取，列顺序见 _SELECT_DAY_ROWS
+_SELECT_DAY_ROWS = """
+    SELECT message_id, user_id, username, text, media_type, reply_to, date, thread_id
+    FROM messages
+    WHERE chat_id = ? AND date_ts >= ? AND date_ts < ?
+    ORDER BY date_ts ASC
+"""
+MessageRow = Tuple[int, Optional[int], Optional[str], Optional[str], Optional[str], Optional[int], str, int]
+_ROW_REPLY_TO = 5
+_ROW_THREAD_ID = 7
+_row_date = itemgetter(6)
+
+# 与 message_handler.format_user 一致的用户显示名称表达式：优先 @username，其次 user_{id}，最后 unknown
+_USER_KEY_SQL = """
+    CASE
+        WHEN username IS NOT NULL AND username != '' THEN '@' || username
+        WHEN user_id IS NOT NULL AND user_id != 0 THEN 'user_' || user_id
+        ELSE 'unknown'
+    END
+"""
+
+
+def _query_statistics(
+    conn: sqlite3.Connection, chat_id: int, start: int, end: int
+) -> Tuple[int, int, List[Tuple[str, int]], Dict[str, int]]:
     """
-    计算消息统计数据
+    在 SQL 中聚合计算消息统计数据，只把聚合结果取回 Python
     
     Args:
-        rows: 消息行列表
+        conn: 数据库连接
+        chat_id: 群组ID
+        start: 时间范围起点（UNIX 时间戳，包含）
+        end: 时间范围终点（UNIX 时间戳，不包含）
     
     Returns:
-        (user_stats, media_stats, thread_stats) 元组
+        (total, user_count, top_users, media_stats) 元组，
+        top_users 为按消息数降序的 Top N 用户（同数量时先发言者在前），
+        media_stats 同样按数量降序排列
     """
-    user_stats: Dict[str, int] = {}
-    media_stats: Dict[str, int] = {}
-    thread_stats: Dict[int, int] = {}
+    # 聚合结果只按位置读取，使用不带 row_factory 的游标直接返回 tuple，省去构造 sqlite3.Row
+    cur = conn.cursor()
+    cur.row_factory = None
+    params = (chat_id, start, end)
+    total, user_count = cur.execute(
+        f"""
+        SELECT COUNT(*), COUNT(DISTINCT {_USER_KEY_SQL})
+        FROM messages
+        WHERE chat_id = ? AND date_ts >= ? AND date_ts < ?
+        """,
+        params,
+    ).fetchone()
+    top_users: List[Tuple[str, int]] = cur.execute(
+        f"""
+        SELECT {_USER_KEY_SQL} AS user_key, COUNT(*) AS cnt
+        FROM messages
+        WHERE chat_id = ? AND date_ts >= ? AND date_ts < ?
+        GROUP BY user_key
+        ORDER BY cnt DESC, MIN(date_ts) ASC
+        LIMIT ?
+        """,
+        (*params, TOP_N_USERS),
+    ).fetchall()
+    media_stats: Dict[str, int] = dict(
+        cur.execute(
+            """
+            SELECT media_type, COUNT(*)
+            FROM messages
+            WHERE chat_id = ? AND date_ts >= ? AND date_ts < ? AND media_type IS NOT NULL AND media_type != ''
+            GROUP BY media_type
+            ORDER BY COUNT(*) DESC, MIN(date_ts) ASC
+            """,
+            params,
+        )
+    )
+    return total, user_count, top_users, media_stats
 
-    for row in rows:
-        key = format_user(row["user_id"], row["username"])
-        user_stats[key] = user_stats.get(key, 0) + 1
-        if row["media_type"]:
-            media_stats[row["media_type"]] = media_stats.get(row["media_type"], 0) + 1
-        if row["reply_to"]:
-            thread_stats[row["reply_to"]] = thread_stats.get(row["reply_to"], 0) + 1
 
-    return user_stats, media_stats, thread_stats
+# 报告头部模板：固定结构只在模块加载时解析一次，渲染时一次性替换所有字段
+_REPORT_HEADER_TEMPLATE = Template(
+    """\
+# 📊 $date_str $weekday $chat_display_name 日报
+
+---
+
+### 📋 基本信息
+
+| 项目 | 内容 |
+|------|------|
+| **群组名称** | $chat_display_name |
+| **群组 ID** | `$chat_id` |
+| **报告日期** | $date_str ($weekday) |
+| **时间范围** | $time_start ~ $time_end |
+| **总消息数** | **$total** 条 |
+| **发言人数** | **$user_count** 人 |
+
+---
+
+"""
+)
+_WEEKDAY_NAMES = ("周一", "周二", "周三", "周四", "周五", "周六", "周日")
+
+# 原始消息引用中预览文本的转义表：] 和 ) 会破坏链接语法，| 会破坏表格；一次 translate 完成全部替换
+_PREVIEW_ESCAPE = str.maketrans({"]": "\\]", ")": "\\)", "|": "\\|"})
+_PREVIEW_MAX_CHARS = 50
 
 
 def _build_report_header(
-    day_start: datetime, day_end: datetime, chat_id: int, chat_name: Optional[str], total: int, user_count: int
-) -> List[str]:
+    out: TextIO,
+    day_start: datetime,
+    day_end: datetime,
+    chat_id: int,
+    chat_name: Optional[str],
+    total: int,
+    user_count: int,
+) -> None:
     """
-    构建报告头部
+    构建报告头部，直接写入输出缓冲区
     
     Args:
+        out: 报告输出缓冲区
         day_start: 报告开始时间
         day_end: 报告结束时间
         chat_id: 群组ID
         chat_name: 群组名称
         total: 总消息数
         user_count: 发言人数
-    
-    Returns:
-        报告头部行列表
     """
-    lines = []
     date_str = day_start.date().isoformat()
-    chat_display_name = chat_name or f"群组 {chat_id}"
-    
-    # 格式化日期显示
-    weekday_map = {0: "周一", 1: "周二", 2: "周三", 3: "周四", 4: "周五", 5: "周六", 6: "周日"}
-    weekday = weekday_map[day_start.weekday()]
-    date_display = f"{date_str} {weekday}"
-    
-    # 格式化时间范围（只显示日期和时间，不显示时区）
-    time_start = day_start.strftime("%H:%M")
-    time_end = day_end.strftime("%H:%M")
-    
-    lines.append(f"# 📊 {date_display} {chat_display_name} 日报")
-    lines.append("")
-    lines.append("---")
-    lines.append("")
-    lines.append("### 📋 基本信息")
-    lines.append("")
-    lines.append("| 项目 | 内容 |")
-    lines.append("|------|------|")
-    lines.append(f"| **群组名称** | {chat_display_name} |")
-    lines.append(f"| **群组 ID** | `{chat_id}` |")
-    lines.append(f"| **报告日期** | {date_str} ({weekday}) |")
-    lines.append(f"| **时间范围** | {time_start} ~ {time_end} |")
-    lines.append(f"| **总消息数** | **{total}** 条 |")
-    lines.append(f"| **发言人数** | **{user_count}** 人 |")
-    lines.append("")
-    lines.append("---")
-    lines.append("")
-    return lines
+    out.write(
+        _REPORT_HEADER_TEMPLATE.substitute(
+            chat_display_name=chat_name or f"群组 {chat_id}",
+            chat_id=chat_id,
+            date_str=date_str,
+            weekday=_WEEKDAY_NAMES[day_start.weekday()],
+            # 格式化时间范围（只显示日期和时间，不显示时区）
+            time_start=day_start.strftime("%H:%M"),
+            time_end=day_end.strftime("%H:%M"),
+            total=total,
+            user_count=user_count,
+        )
+    )
 
 
 def _build_report_content(
-    user_stats: Dict[str, int], 
+    out: TextIO,
+    top_users: List[Tuple[str, int]], 
     media_stats: Dict[str, int], 
     thread_stats: Dict[int, int],
     conn: sqlite3.Connection,
     chat_id: int,
     chat_link: Optional[str] = None,
-) -> List[str]:
+) -> None:
     """
-    构建报告内容部分（活跃用户、媒体分布）
+    构建报告内容部分（活跃用户、媒体分布），直接写入输出缓冲区
     
     Args:
-        user_stats: 用户统计
-        media_stats: 媒体统计
+        out: 报告输出缓冲区
+        top_users: 按消息数降序的 Top N 用户
+        media_stats: 媒体统计（按数量降序）
         thread_stats: 线程统计（已弃用，保留以兼容接口）
         conn: 数据库连接
         chat_id: 群组ID
         chat_link: 群组链接（可选）
-    
-    Returns:
-        报告内容行列表
     """
-    lines = []
-    top_users = sorted(user_stats.items(), key=lambda x: x[1], reverse=True)[:TOP_N_USERS]
-
     # 活跃用户 Top 5
-    lines.append("## 👥 活跃用户 Top 5")
-    lines.append("")
+    out.write("## 👥 活跃用户 Top 5\n")
+    out.write("\n")
     if top_users:
-        lines.append("| 排名 | 用户名 | 消息数 |")
-        lines.append("|------|--------|--------|")
+        out.write("| 排名 | 用户名 | 消息数 |\n")
+        out.write("|------|--------|--------|\n")
         rank_icons = ["🥇", "🥈", "🥉", "4️⃣", "5️⃣"]
         for idx, (name, cnt) in enumerate(top_users):
             rank_icon = rank_icons[idx] if idx < len(rank_icons) else f"{idx + 1}."
-            lines.append(f"| {rank_icon} | {name} | **{cnt}** |")
+            out.write(f"| {rank_icon} | {name} | **{cnt}** |\n")
     else:
-        lines.append("*暂无活跃用户数据*")
-    lines.append("")
+        out.write("*暂无活跃用户数据*\n")
+    out.write("\n")
 
     # 媒体分布
-    lines.append("## 📎 媒体分布")
-    lines.append("")
+    out.write("## 📎 媒体分布\n")
+    out.write("\n")
     if media_stats:
         # 媒体类型显示名称映射
         media_display_names = {
@@ -151,18 +229,17 @@ def _build_report_content(
             "MessageMediaVoice": "🎤 语音",
         }
         
-        lines.append("| 媒体类型 | 数量 |")
-        lines.append("|----------|------|")
+        out.write("| 媒体类型 | 数量 |\n")
+        out.write("|----------|------|\n")
         total_media = sum(media_stats.values())
-        for media_type, cnt in sorted(media_stats.items(), key=lambda x: x[1], reverse=True):
+        # media_stats 已由 SQL 按数量降序排列
+        for media_type, cnt in media_stats.items():
             display_name = media_display_names.get(media_type, f"📎 {media_type}")
             percentage = (cnt / total_media * 100) if total_media > 0 else 0
-            lines.append(f"| {display_name} | **{cnt}** ({percentage:.1f}%) |")
+            out.write(f"| {display_name} | **{cnt}** ({percentage:.1f}%) |\n")
     else:
-        lines.append("*今日无媒体消息*")
-    lines.append("")
-
-    return lines
+        out.write("*今日无媒体消息*\n")
+    out.write("\n")
 
 
 def generate_report(
@@ -174,8 +251,8 @@ def generate_report(
     chat_type: Optional[str] = None,
     chat_link: Optional[str] = None,
     min_thread_messages: Optional[int] = None,
-) -> str:
-    """为指定群组生成日报"""
+) -> Path:
+    """为指定群组生成日报，直接流式写入报告文件，返回报告文件路径"""
     day_end = day_start + timedelta(days=1)
     tz_name = getattr(cfg.timezone, "key", None) or str(cfg.timezone)
     day_start_utc = day_start.astimezone(timezone.utc)
@@ -196,31 +273,22 @@ def generate_report(
         day_end_utc.isoformat(),
     )
 
-    conn.row_factory = sqlite3.Row
-    cur = conn.execute(
-        """
-        SELECT message_id, user_id, username, text, media_type, reply_to, date, thread_id
-        FROM messages
-        WHERE chat_id = ? AND date >= ? AND date < ?
-        ORDER BY date ASC
-        """,
-        (chat_id, day_start.isoformat(), day_end.isoformat()),
-    )
-    rows = cur.fetchall()
-    total = len(rows)
-
-    log.info("Found %s messages in database for time range", total)
+    start_ts = int(day_start.timestamp())
+    end_ts = int(day_end.timestamp())
 
-    # 计算统计数据
-    user_stats, media_stats, thread_stats = _calculate_statistics(rows)
+    # 计算统计数据（在 SQL 中聚合）
+    total, user_count, top_users, media_stats = _query_statistics(conn, chat_id, start_ts, end_ts)
 
-    # 构建报告
-    lines = _build_report_header(day_start, day_end, chat_id, chat_name, total, len(user_stats))
-    lines.extend(_build_report_content(user_stats, media_stats, thread_stats, conn, chat_id, chat_link))
+    log.info("Found %s messages in database for time range", total)
 
-    lines.extend(build_ai_summary_section(rows, cfg, day_start, chat_id, chat_name, chat_type, chat_link, conn, min_thread_messages))
+    # 只有生成 AI 摘要时才需要读取完整的消息行（以 tuple 形式读取，按位置解包）；
+    # 直接把游标交给摘要部分逐行消费，不先 fetchall 物化整个结果列表
+    rows: Iterable[MessageRow] = ()
+    if cfg.enable_ai_summary:
+        cur = conn.cursor()
+        cur.row_factory = None
+        rows = cur.execute(_SELECT_DAY_ROWS, (chat_id, start_ts, end_ts))
 
-    report = "\n".join(lines)
     # 报告文件名包含 chat_id，如果有名称则使用名称（清理特殊字符）
     date_str = day_start.date().isoformat()
     if chat_name:
@@ -229,39 +297,120 @@ def generate_report(
     else:
         report_filename = f"{date_str}_{chat_id}.md"
     report_path = cfg.report_dir / report_filename
-    report_path.write_text(report, encoding="utf-8")
+
+    # 各部分边生成边写入临时文件，不在内存中拼出整份报告；
+    # 写完后再 os.replace 替换，避免写入中途崩溃留下不完整的报告
+    # 写入失败时删除临时文件，不在 report_dir 中留下残缺的 .md.tmp
+    tmp_path = report_path.with_suffix(".md.tmp")
+    try:
+        with tmp_path.open("w", encoding="utf-8") as out:
+            _build_report_header(out, day_start, day_end, chat_id, chat_name, total, user_count)
+            _build_report_content(out, top_users, media_stats, {}, conn, chat_id, chat_link)
+            build_ai_summary_section(out, rows, cfg, day_start, chat_id, chat_name, chat_type, chat_link, conn, min_thread_messages)
+        os.replace(tmp_path, report_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
     log.info("Report written to %s", report_path)
-    return report
+    return report_path
 
 
-def _group_messages_by_thread(rows: List[sqlite3.Row]) -> Dict[int, List[sqlite3.Row]]:
+def _index_day_rows(
+    rows: Iterable[MessageRow],
+) -> Tuple[Dict[int, List[MessageRow]], Dict[int, MessageRow], Dict[int, str]]:
     """
-    按 thread_id 分组消息，并确保每个线程内的消息按时间顺序排序
+    一次遍历当天消息行，同时完成按线程分组、按消息ID索引和预览文本生成
     
     Args:
-        rows: 消息行列表（应该已经按时间排序）
+        rows: 消息行（列表或游标，只遍历一次；应该已经按时间排序）
     
     Returns:
-        按 thread_id 分组的消息字典，每个线程内的消息按时间顺序排序
+        (threads, rows_by_id, preview_map)：
+        按 thread_id 分组的消息字典（每个线程内按时间顺序排序）、
+        消息ID到消息行的映射、消息ID到原始引用预览文本的映射
     """
-    threads: Dict[int, List[sqlite3.Row]] = {}
+    threads: DefaultDict[int, List[MessageRow]] = defaultdict(list)
+    rows_by_id: Dict[int, MessageRow] = {}
+    preview_map: Dict[int, str] = {}
     for row in rows:
-        thread_id = row["thread_id"]
-        if thread_id not in threads:
-            threads[thread_id] = []
-        threads[thread_id].append(row)
+        threads[row[_ROW_THREAD_ID]].append(row)
+        message_id = row[0]
+        rows_by_id[message_id] = row
+        preview_map[message_id] = _message_preview(row[3])
     
     # 确保每个线程内的消息按时间顺序排序
-    for thread_id in threads:
-        threads[thread_id].sort(key=lambda r: r["date"])
+    for thread_rows in threads.values():
+        thread_rows.sort(key=_row_date)
     
-    return threads
+    return dict(threads), rows_by_id, preview_map
+
+
+def _replied_message(
+    message_id: int,
+    user_id: Optional[int],
+    username: Optional[str],
+    text: Optional[str],
+    media_type: Optional[str],
+    date: str,
+) -> Dict[str, Any]:
+    """构建发送给 AI 的被回复消息详情"""
+    return {
+        "id": message_id,
+        "user": format_user(user_id, username),
+        "text": text or "",
+        "media_type": media_type,
+        "ts": date,
+    }
+
+
+def _build_replied_map(
+    conn: sqlite3.Connection,
+    chat_id: int,
+    rows_by_id: Dict[int, MessageRow],
+    valid_threads: Dict[int, List[MessageRow]],
+) -> Dict[int, Dict[str, Any]]:
+    """
+    构建待分析线程中所有被回复消息的详情映射
+    
+    被回复的消息大多就在当天的消息行中，直接从内存取用；
+    其余（更早的消息）再一次批量查询数据库。每条被回复消息只构建一次详情字典。
+    
+    Args:
+        conn: 数据库连接
+        chat_id: 群组ID
+        rows_by_id: 当天全部消息（消息ID到消息行的映射）
+        valid_threads: 需要进行 AI 分析的线程
+    
+    Returns:
+        消息ID到被回复消息详情的映射，不存在的消息不会出现在结果中
+    """
+    reply_ids = {
+        row[_ROW_REPLY_TO]
+        for thread_rows in valid_threads.values()
+        for row in thread_rows
+        if row[_ROW_REPLY_TO]
+    }
+    replied_map: Dict[int, Dict[str, Any]] = {}
+    missing_ids: List[int] = []
+    for reply_id in reply_ids:
+        row = rows_by_id.get(reply_id)
+        if row is None:
+            missing_ids.append(reply_id)
+            continue
+        message_id, user_id, username, text, media_type, _, date, _ = row
+        replied_map[message_id] = _replied_message(message_id, user_id, username, text, media_type, date)
+    
+    if missing_ids:
+        for message_id, row in get_replied_messages(conn, chat_id, missing_ids).items():
+            replied_map[message_id] = _replied_message(
+                message_id, row["user_id"], row["username"], row["text"], row["media_type"], row["date"]
+            )
+    return replied_map
 
 
 def _convert_rows_to_messages(
-    rows: List[sqlite3.Row], 
-    conn: sqlite3.Connection, 
-    chat_id: int
+    rows: List[MessageRow], 
+    replied_map: Dict[int, Dict[str, Any]],
 ) -> List[Dict[str, Any]]:
     """
     将数据库行转换为消息字典列表，包含完整的回复关系信息
@@ -271,44 +420,37 @@ def _convert_rows_to_messages(
     
     Args:
         rows: 消息行列表（应该已经按时间排序）
-        conn: 数据库连接
-        chat_id: 群组ID
+        replied_map: 由 _build_replied_map 预先构建的被回复消息（消息ID到 replied_message 字典的映射）
     
     Returns:
         消息字典列表，包含回复关系信息，按时间顺序排序
     """
     # 确保输入的消息按时间排序
-    sorted_rows = sorted(rows, key=lambda r: r["date"])
+    sorted_rows = sorted(rows, key=_row_date)
     
     messages = []
     skipped_count = 0
-    for row in sorted_rows:
+    for message_id, user_id, username, text, media_type, reply_to, date, _ in sorted_rows:
         msg_dict = {
-            "id": row["message_id"],
-            "user": format_user(row["user_id"], row["username"]),
-            "ts": row["date"],
-            "text": row["text"] or "",
-            "media_type": row["media_type"],
-            "reply_to": row["reply_to"],
+            "id": message_id,
+            "user": format_user(user_id, username),
+            "ts": date,
+            "text": text or "",
+            "media_type": media_type,
+            "reply_to": reply_to,
         }
         
         # 如果消息有回复关系，查询被回复的消息详情
-        if row["reply_to"]:
-            replied_msg = get_replied_message(conn, chat_id, row["reply_to"])
+        if reply_to:
+            replied_msg = replied_map.get(reply_to)
             if replied_msg:
                 # 被回复的消息在数据库中，包含完整信息
-                msg_dict["replied_message"] = {
-                    "id": replied_msg["message_id"],
-                    "user": format_user(replied_msg["user_id"], replied_msg["username"]),
-                    "text": replied_msg["text"] or "",
-                    "media_type": replied_msg["media_type"],
-                    "ts": replied_msg["date"],
-                }
+                msg_dict["replied_message"] = replied_msg
                 messages.append(msg_dict)
             else:
                 # 被回复的消息不在数据库中，跳过这条回复消息
                 skipped_count += 1
-                log.debug("Skipping message %s: replied message %s not in database", row["message_id"], row["reply_to"])
+                log.debug("Skipping message %s: replied message %s not in database", message_id, reply_to)
                 continue
         else:
             # 没有回复关系，直接添加
@@ -320,19 +462,21 @@ def _convert_rows_to_messages(
     return messages
 
 
-def _build_ai_payload(
+def _build_base_payload(
     chat_id: int,
     chat_name: Optional[str],
     chat_type: Optional[str],
     day_start: datetime,
     tz_name: str,
     thread_id: int,
-    messages: List[Dict[str, Any]],
     cfg: Config,
-    batch_info: Optional[str] = None,
+    batched: bool = False,
 ) -> Dict[str, Any]:
     """
-    构建 AI 分析请求的 payload
+    构建一个线程的 AI 请求 payload 公共部分（各批次相同），每个线程只构建一次
+    
+    messages（以及分批时的 batch_info）先占位，调用方 copy 后填入；
+    占位保证键顺序不变，从而序列化出的提示词与缓存键保持稳定。
     
     Args:
         chat_id: 群组ID
@@ -341,12 +485,11 @@ def _build_ai_payload(
         day_start: 报告开始时间
         tz_name: 时区名称
         thread_id: 线程ID
-        messages: 消息列表
         cfg: 配置对象
-        batch_info: 批次信息（可选）
+        batched: 是否分批处理（为 True 时包含 batch_info 字段）
     
     Returns:
-        AI 请求 payload
+        AI 请求 payload 的公共部分
     """
     payload: Dict[str, Any] = {
         "chat_id": chat_id,
@@ -355,10 +498,10 @@ def _build_ai_payload(
         "date": day_start.date().isoformat(),
         "timezone": tz_name,
         "thread_id": thread_id,
-        "messages": messages,
+        "messages": [],
     }
-    if batch_info:
-        payload["batch_info"] = batch_info
+    if batched:
+        payload["batch_info"] = ""
     if cfg.ai_max_categories:
         payload["max_categories"] = cfg.ai_max_categories
     if cfg.ai_style:
@@ -366,6 +509,11 @@ def _build_ai_payload(
     return payload
 
 
+def _category_priority(cat_name: str) -> int:
+    """分类名称对应的排序优先级（数值越小越靠前）"""
+    return CATEGORY_PRIORITY.get(cat_name, DEFAULT_CATEGORY_PRIORITY)
+
+
 def _sort_categories_by_priority(categories: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     按优先级对分类进行排序
@@ -376,84 +524,96 @@ def _sort_categories_by_priority(categories: List[Dict[str, Any]]) -> List[Dict[
     Returns:
         排序后的分类列表
     """
-    def get_priority(cat: Dict[str, Any]) -> int:
-        cat_name = cat.get("name", "")
-        return CATEGORY_PRIORITY.get(cat_name, DEFAULT_CATEGORY_PRIORITY)
+    return sorted(categories, key=lambda cat: _category_priority(cat.get("name", "")))
+
 
-    return sorted(categories, key=get_priority)
+def _new_category_map() -> DefaultDict[str, Dict[str, Any]]:
+    """
+    创建空的分类合并字典
+    
+    message_ids 以 dict 作为有序集合，合并时即完成去重，无需事后再扫描一遍
+    """
+    return defaultdict(lambda: {"message_ids": {}, "summaries": []})
 
 
-def _merge_categories(categories_list: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+def _merge_categories_into(
+    category_map: DefaultDict[str, Dict[str, Any]],
+    categories: Iterable[Dict[str, Any]],
+) -> None:
     """
-    合并相同名称的分类
+    将一组分类按名称合并进已有的分类字典（原地更新）
     
     Args:
-        categories_list: 分类列表
-    
-    Returns:
-        合并后的分类字典，key 为分类名称，value 包含合并后的消息ID和摘要列表
+        category_map: 由 _new_category_map 创建的分类字典
+        categories: AI 返回的分类列表
     """
-    category_map: Dict[str, Dict[str, Any]] = {}
-    for cat in categories_list:
-        name = cat.get("name") or "未命名分类"
-        if name not in category_map:
-            category_map[name] = {"message_ids": [], "summaries": []}
+    for cat in categories:
+        entry = category_map[cat.get("name") or "未命名分类"]
         
         summary = cat.get("summary") or ""
         if summary:
-            category_map[name]["summaries"].append(summary)
+            entry["summaries"].append(summary)
         
-        msg_ids = cat.get("messages") or []
-        category_map[name]["message_ids"].extend(msg_ids)
+        entry["message_ids"].update(dict.fromkeys(cat.get("messages") or []))
+
+
+def _merge_categories(categories_list: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    合并相同名称的分类
     
-    # 去重消息ID
-    for name in category_map:
-        category_map[name]["message_ids"] = list(dict.fromkeys(category_map[name]["message_ids"]))
+    Args:
+        categories_list: 分类列表
     
-    return category_map
+    Returns:
+        合并后的分类字典，key 为分类名称，value 包含合并后的消息ID（已去重）和摘要列表
+    """
+    category_map = _new_category_map()
+    _merge_categories_into(category_map, categories_list)
+    return dict(category_map)
+
+
+def _message_preview(text: Optional[str]) -> str:
+    """生成原始消息引用中的预览文本：换行替换为空格（避免打断列表项），截取前 50 个字符并转义 Markdown 特殊字符，无文本时为媒体占位"""
+    text = (text or "").replace("\n", " ").strip()
+    if not text:
+        return "[媒体消息]"
+    if len(text) > _PREVIEW_MAX_CHARS:
+        return text[:_PREVIEW_MAX_CHARS].translate(_PREVIEW_ESCAPE) + "..."
+    return text.translate(_PREVIEW_ESCAPE)
 
 
 def _format_category_output(
+    out: TextIO,
     category_map: Dict[str, Dict[str, Any]], 
     is_batch: bool = False,
     chat_link: Optional[str] = None,
-    message_map: Optional[Dict[int, Dict[str, Any]]] = None,
-) -> List[str]:
+    preview_map: Optional[Dict[int, str]] = None,
+) -> None:
     """
-    格式化分类输出
+    格式化分类输出，直接写入输出缓冲区
     
     Args:
-        category_map: 合并后的分类字典
+        out: 报告输出缓冲区
+        category_map: 合并后的分类字典（已按优先级排列，按插入顺序输出）
         is_batch: 是否为批次处理
         chat_link: 群组链接，用于生成消息链接
-        message_map: 消息ID到消息详情的映射
-    
-    Returns:
-        格式化的分类输出行列表
+        preview_map: 消息ID到已截断、已转义的预览文本的映射
     """
-    lines = []
-    
-    def get_priority(cat_name: str) -> int:
-        return CATEGORY_PRIORITY.get(cat_name, DEFAULT_CATEGORY_PRIORITY)
-    
-    sorted_names = sorted(category_map.keys(), key=get_priority)
-    
-    lines.append("#### 📂 分类详情")
+    out.write("#### 📂 分类详情\n")
     if is_batch:
-        lines.append("*（合并所有批次）*")
-    lines.append("")
+        out.write("*（合并所有批次）*\n")
+    out.write("\n")
     
     # 收集所有消息ID用于原始引用部分
     all_message_refs: List[Tuple[int, str]] = []
     
-    for name in sorted_names:
-        cat_data = category_map[name]
+    for name, cat_data in category_map.items():
         message_ids = cat_data["message_ids"]
         summaries = cat_data["summaries"]
         
         # 分类标题
-        lines.append(f"##### 🔸 {name}")
-        lines.append("")
+        out.write(f"##### 🔸 {name}\n")
+        out.write("\n")
         
         if summaries:
             if is_batch and len(summaries) > 1:
@@ -465,33 +625,19 @@ def _format_category_output(
             summary_lines = combined_summary.split("\n")
             for line in summary_lines:
                 if line.strip():
-                    lines.append(f"{line}")
-            lines.append("")
+                    out.write(f"{line}\n")
+            out.write("\n")
         
         # 收集该分类的所有消息引用
         for msg_id in message_ids:
-            if message_map and msg_id in message_map:
-                msg_info = message_map[msg_id]
-                text = msg_info.get("text", "").strip()
-                # 截取消息文本的前50个字符，如果太长则添加省略号
-                if text:
-                    display_text = text[:50] + ("..." if len(text) > 50 else "")
-                    # 转义Markdown链接文本中的特殊字符，避免破坏链接语法
-                    # 在链接文本中，] 和 ) 需要转义，否则会破坏链接语法
-                    display_text = display_text.replace("]", "\\]").replace(")", "\\)")
-                else:
-                    display_text = "[媒体消息]"
-                
-                all_message_refs.append((msg_id, display_text))
-            else:
-                all_message_refs.append((msg_id, ""))
+            all_message_refs.append((msg_id, preview_map.get(msg_id, "") if preview_map else ""))
     
     # 添加原始引用分类
     if all_message_refs:
-        lines.append("---")
-        lines.append("")
-        lines.append("#### 📎 原始消息引用")
-        lines.append("")
+        out.write("---\n")
+        out.write("\n")
+        out.write("#### 📎 原始消息引用\n")
+        out.write("\n")
         # 去重消息ID（保持顺序）
         seen_ids = set()
         unique_refs = []
@@ -505,24 +651,24 @@ def _format_category_output(
             if chat_link:
                 msg_link = f"{chat_link}/{msg_id}"
                 if display_text:
-                    # 转义特殊字符以避免破坏Markdown格式（表格中的 | 需要转义）
-                    safe_text = display_text.replace("|", "\\|")
-                    lines.append(f"{idx}. [{msg_id}]({msg_link})：{safe_text}")
+                    out.write(f"{idx}. [{msg_id}]({msg_link})：{display_text}\n")
                 else:
-                    lines.append(f"{idx}. [{msg_id}]({msg_link})")
+                    out.write(f"{idx}. [{msg_id}]({msg_link})\n")
             else:
                 if display_text:
-                    safe_text = display_text.replace("|", "\\|")
-                    lines.append(f"{idx}. {msg_id}：{safe_text}")
+                    out.write(f"{idx}. {msg_id}：{display_text}\n")
                 else:
-                    lines.append(f"{idx}. {msg_id}")
-        lines.append("")
+                    out.write(f"{idx}. {msg_id}\n")
+        out.write("\n")
     
-    return lines
 
 
-def _process_single_thread(
-    thread_rows: List[sqlite3.Row],
+# 一次 AI 调用的结果：成功时为解析后的响应，失败时为对应的 AISummaryError
+AIOutcome = Union[Dict[str, Any], AISummaryError]
+
+
+def _prepare_thread_payloads(
+    thread_rows: List[MessageRow],
     thread_id: int,
     cfg: Config,
     day_start: datetime,
@@ -530,12 +676,12 @@ def _process_single_thread(
     chat_id: int,
     chat_name: Optional[str],
     chat_type: Optional[str],
-    chat_link: Optional[str],
-    message_map: Dict[int, Dict[str, Any]],
-    conn: sqlite3.Connection,
-) -> List[str]:
+    replied_map: Dict[int, Dict[str, Any]],
+) -> List[Dict[str, Any]]:
     """
-    处理单个线程（不分批）
+    构建单个线程的 AI 请求 payload（消息数量超过 ai_max_messages_per_batch 时按批次拆分）
+    
+    在主线程中执行，构建结果再交给线程池并发请求。
     
     Args:
         thread_rows: 线程消息行
@@ -546,167 +692,195 @@ def _process_single_thread(
         chat_id: 群组ID
         chat_name: 群组名称
         chat_type: 群组类型
-        conn: 数据库连接
+        replied_map: 预先批量查询好的被回复消息
     
     Returns:
-        处理结果行列表
+        payload 列表，不分批时只有一个元素
+    """
+    total_messages = len(thread_rows)
+    batch_size = cfg.ai_max_messages_per_batch
+    if total_messages <= batch_size:
+        payload = _build_base_payload(chat_id, chat_name, chat_type, day_start, tz_name, thread_id, cfg)
+        payload["messages"] = _convert_rows_to_messages(thread_rows, replied_map)
+        return [payload]
+
+    base_payload = _build_base_payload(chat_id, chat_name, chat_type, day_start, tz_name, thread_id, cfg, batched=True)
+    num_batches = -(-total_messages // batch_size)
+    payloads = []
+    for batch_idx, start_idx in enumerate(range(0, total_messages, batch_size)):
+        batch_rows = thread_rows[start_idx:start_idx + batch_size]
+        payload = base_payload.copy()
+        payload["messages"] = _convert_rows_to_messages(batch_rows, replied_map)
+        payload["batch_info"] = f"批次 {batch_idx + 1}/{num_batches}，共 {total_messages} 条消息"
+        payloads.append(payload)
+    return payloads
+
+
+def _call_ai(cfg: Config, payload: Dict[str, Any], semantic_cache: Optional[SemanticCache]) -> AIOutcome:
+    """
+    发送一次 AI 分析请求（在线程池中执行）
+    
+    语义缓存实例由调用方在主线程中获取后传入，避免各工作线程并发初始化各自的实例
+    
+    Returns:
+        解析后的响应；请求失败时返回 AISummaryError 而不是抛出，由渲染阶段按批次处理
     """
-    lines = []
-    messages = _convert_rows_to_messages(thread_rows, conn, chat_id)
-    payload = _build_ai_payload(
-        chat_id, chat_name, chat_type, day_start, tz_name, thread_id, messages, cfg
-    )
-
     log.info(
-        "Calling AI summary for thread %s: base=%s model=%s messages=%s",
-        thread_id,
+        "Calling AI summary for thread %s%s: base=%s model=%s messages=%s",
+        payload["thread_id"],
+        f" ({payload['batch_info']})" if "batch_info" in payload else "",
         cfg.ai_api_base,
         cfg.ai_model,
-        len(messages),
+        len(payload["messages"]),
     )
     try:
-        data = call_chat_analysis(
-            cfg.ai_api_base, cfg.ai_api_key, payload, model=cfg.ai_model, timeout=cfg.ai_timeout
+        return call_chat_analysis(
+            cfg.ai_api_base,
+            cfg.ai_api_key,
+            payload,
+            model=cfg.ai_model,
+            timeout=cfg.ai_timeout,
+            cache_dir=cfg.ai_cache_dir if cfg.ai_cache_enabled else None,
+            cache_ttl=cfg.ai_cache_ttl_hours * 3600 if cfg.ai_cache_ttl_hours > 0 else None,
+            semantic_cache=semantic_cache,
+            stream=cfg.ai_stream,
         )
     except AISummaryError as exc:
-        lines.append("⚠️ **AI 摘要生成失败**")
-        lines.append("")
-        lines.append(f"错误信息：{exc}")
-        lines.append("")
-        log.warning("AI summary failed for thread %s: %s", thread_id, exc)
-        return lines
+        return exc
+
+
+def _iter_ai_outcomes(
+    cfg: Config,
+    payloads: List[Dict[str, Any]],
+    semantic_cache: Optional[SemanticCache] = None,
+) -> Iterator[AIOutcome]:
+    """
+    并发执行所有 AI 请求（并发数由 ai_concurrency 控制），按 payloads 顺序逐个产出结果
+    
+    请求全部提交后，前面的结果一就绪就产出，调用方可以边等待后续请求边渲染、写入报告。
+    
+    Returns:
+        与 payloads 顺序一致的结果迭代器
+    """
+    if cfg.ai_concurrency <= 1 or len(payloads) <= 1:
+        for payload in payloads:
+            yield _call_ai(cfg, payload, semantic_cache)
+        return
+    workers = min(cfg.ai_concurrency, len(payloads))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ai") as executor:
+        yield from executor.map(lambda payload: _call_ai(cfg, payload, semantic_cache), payloads)
+
+
+def _render_single_thread(
+    out: TextIO,
+    thread_id: int,
+    outcome: AIOutcome,
+    chat_link: Optional[str],
+    preview_map: Dict[int, str],
+) -> None:
+    """
+    渲染单个线程（不分批）的 AI 分析结果，直接写入输出缓冲区
+    
+    Args:
+        out: 报告输出缓冲区
+        thread_id: 线程ID
+        outcome: AI 调用结果
+        chat_link: 群组链接（可选）
+        preview_map: 消息ID到预览文本的映射
+    """
+    if isinstance(outcome, AISummaryError):
+        out.write("⚠️ **AI 摘要生成失败**\n")
+        out.write("\n")
+        out.write(f"错误信息：{outcome}\n")
+        out.write("\n")
+        log.warning("AI summary failed for thread %s: %s", thread_id, outcome)
+        return
+    data = outcome
 
     overall = data.get("overall")
     if overall:
-        lines.append("#### 📝 总览")
-        lines.append("")
-        lines.append(f"> {overall}")
-        lines.append("")
+        out.write("#### 📝 总览\n")
+        out.write("\n")
+        out.write(f"> {overall}\n")
+        out.write("\n")
 
     categories = data.get("categories") or []
     if categories:
         sorted_categories = _sort_categories_by_priority(categories)
         category_map = _merge_categories(sorted_categories)
-        lines.extend(_format_category_output(category_map, is_batch=False, chat_link=chat_link, message_map=message_map))
+        _format_category_output(out, category_map, is_batch=False, chat_link=chat_link, preview_map=preview_map)
     else:
-        lines.append("*未返回分类结果*")
-        lines.append("")
+        out.write("*未返回分类结果*\n")
+        out.write("\n")
 
-    return lines
 
-
-def _process_thread_batch(
-    thread_rows: List[sqlite3.Row],
+def _render_thread_batch(
+    out: TextIO,
     thread_id: int,
+    outcomes: List[AIOutcome],
     cfg: Config,
-    day_start: datetime,
-    tz_name: str,
-    chat_id: int,
-    chat_name: Optional[str],
-    chat_type: Optional[str],
     chat_link: Optional[str],
-    message_map: Dict[int, Dict[str, Any]],
-    conn: sqlite3.Connection,
-) -> List[str]:
+    preview_map: Dict[int, str],
+) -> None:
     """
-    处理线程的批次（分批处理）
+    渲染分批处理的线程的 AI 分析结果，直接写入输出缓冲区
     
     Args:
-        thread_rows: 线程消息行
+        out: 报告输出缓冲区
         thread_id: 线程ID
+        outcomes: 各批次的 AI 调用结果（按批次顺序）
         cfg: 配置对象
-        day_start: 报告开始时间
-        tz_name: 时区名称
-        chat_id: 群组ID
-        chat_name: 群组名称
-        chat_type: 群组类型
-        conn: 数据库连接
-    
-    Returns:
-        处理结果行列表
+        chat_link: 群组链接（可选）
+        preview_map: 消息ID到预览文本的映射
     """
-    lines = []
-    total_messages = len(thread_rows)
-    num_batches = (total_messages + cfg.ai_max_messages_per_batch - 1) // cfg.ai_max_messages_per_batch
+    num_batches = len(outcomes)
     
-    lines.append("#### ⚙️ 批次处理信息")
-    lines.append("")
-    lines.append(f"消息数量较多，将分成 **{num_batches}** 个批次处理（每批最多 {cfg.ai_max_messages_per_batch} 条）")
-    lines.append("")
+    out.write("#### ⚙️ 批次处理信息\n")
+    out.write("\n")
+    out.write(f"消息数量较多，将分成 **{num_batches}** 个批次处理（每批最多 {cfg.ai_max_messages_per_batch} 条）\n")
+    out.write("\n")
 
     all_overalls: List[str] = []
-    all_categories: List[Dict[str, Any]] = []
+    # 每个批次的分类在拿到响应后立即合并，不再先汇总成大列表再整体扫描
+    category_map = _new_category_map()
     batch_failed = False
 
-    # 分段处理
-    for batch_idx in range(num_batches):
-        start_idx = batch_idx * cfg.ai_max_messages_per_batch
-        end_idx = min(start_idx + cfg.ai_max_messages_per_batch, total_messages)
-        batch_rows = thread_rows[start_idx:end_idx]
-        batch_num = batch_idx + 1
-
-        messages = _convert_rows_to_messages(batch_rows, conn, chat_id)
-        payload = _build_ai_payload(
-            chat_id,
-            chat_name,
-            chat_type,
-            day_start,
-            tz_name,
-            thread_id,
-            messages,
-            cfg,
-            batch_info=f"批次 {batch_num}/{num_batches}，共 {total_messages} 条消息",
-        )
-
-        log.info(
-            "Calling AI summary for thread %s batch %s/%s: base=%s model=%s messages=%s",
-            thread_id,
-            batch_num,
-            num_batches,
-            cfg.ai_api_base,
-            cfg.ai_model,
-            len(messages),
-        )
-        try:
-            data = call_chat_analysis(
-                cfg.ai_api_base, cfg.ai_api_key, payload, model=cfg.ai_model, timeout=cfg.ai_timeout
-            )
-        except AISummaryError as exc:
-            lines.append(f"⚠️ **批次 {batch_num} AI 摘要生成失败**：{exc}")
-            lines.append("")
-            log.warning("AI summary failed for thread %s batch %s: %s", thread_id, batch_num, exc)
+    for batch_num, outcome in enumerate(outcomes, start=1):
+        if isinstance(outcome, AISummaryError):
+            out.write(f"⚠️ **批次 {batch_num} AI 摘要生成失败**：{outcome}\n")
+            out.write("\n")
+            log.warning("AI summary failed for thread %s batch %s: %s", thread_id, batch_num, outcome)
             batch_failed = True
             continue
+        data = outcome
 
         batch_overall = data.get("overall")
         if batch_overall:
             all_overalls.append(f"批次 {batch_num}: {batch_overall}")
 
-        batch_categories = data.get("categories") or []
-        if batch_categories:
-            all_categories.extend(batch_categories)
+        _merge_categories_into(category_map, data.get("categories") or [])
 
     # 合并所有批次的结果
-    if batch_failed and not all_overalls and not all_categories:
-        lines.append("⚠️ **所有批次处理失败**")
-        lines.append("")
+    if batch_failed and not all_overalls and not category_map:
+        out.write("⚠️ **所有批次处理失败**\n")
+        out.write("\n")
     else:
         if all_overalls:
-            lines.append("#### 📝 总览（各批次摘要）")
-            lines.append("")
+            out.write("#### 📝 总览（各批次摘要）\n")
+            out.write("\n")
             for overall in all_overalls:
-                lines.append(f"- {overall}")
-            lines.append("")
+                out.write(f"- {overall}\n")
+            out.write("\n")
 
-        if all_categories:
-            category_map = _merge_categories(all_categories)
-            lines.extend(_format_category_output(category_map, is_batch=True, chat_link=chat_link, message_map=message_map))
-
-    return lines
+        if category_map:
+            # 各批次的分类按到达顺序合并，输出前按优先级排序一次
+            ordered_map = dict(sorted(category_map.items(), key=lambda item: _category_priority(item[0])))
+            _format_category_output(out, ordered_map, is_batch=True, chat_link=chat_link, preview_map=preview_map)
 
 
 def build_ai_summary_section(
-    rows: List[sqlite3.Row],
+    out: TextIO,
+    rows: Iterable[MessageRow],
     cfg: Config,
     day_start: datetime,
     chat_id: int,
@@ -715,74 +889,81 @@ def build_ai_summary_section(
     chat_link: Optional[str] = None,
     conn: Optional[sqlite3.Connection] = None,
     min_thread_messages: Optional[int] = None,
-) -> List[str]:
+) -> None:
+    """构建 AI 话题摘要部分，直接写入输出缓冲区（未启用 AI 摘要时不写入任何内容）"""
     if not cfg.enable_ai_summary:
-        return []
+        return
 
-    lines = ["", "---", "", "## 🤖 智能话题摘要"]
+    out.write("\n---\n\n## 🤖 智能话题摘要\n")
 
     if not cfg.ai_api_base:
-        lines.append("⚠️ **AI 摘要未生成**：缺少 `ai_api_base` 配置")
+        out.write("⚠️ **AI 摘要未生成**：缺少 `ai_api_base` 配置\n")
         log.warning("AI summary enabled but ai_api_base not set.")
-        return lines
+        return
 
     if not cfg.ai_api_key:
-        lines.append("⚠️ **AI 摘要未生成**：缺少 `ai_api_key` 配置")
+        out.write("⚠️ **AI 摘要未生成**：缺少 `ai_api_key` 配置\n")
         log.warning("AI summary enabled but ai_api_key not set.")
-        return lines
+        return
     
     if not conn:
-        lines.append("⚠️ **AI 摘要未生成**：缺少数据库连接")
+        out.write("⚠️ **AI 摘要未生成**：缺少数据库连接\n")
         log.warning("AI summary enabled but database connection not provided.")
-        return lines
+        return
 
     # 确定使用的最小消息数量阈值：优先使用群组特定配置，否则使用全局默认值
     threshold = min_thread_messages if min_thread_messages is not None else MIN_THREAD_MESSAGES
 
-    # 按 thread_id 分组消息
-    threads = _group_messages_by_thread(rows)
+    # 分组、索引与预览文本在同一次遍历中完成（rows 可能是游标，只在这里遍历一次）
+    threads, rows_by_id, preview_map = _index_day_rows(rows)
 
     # 过滤掉消息数量小于阈值的线程
     valid_threads = {tid: msgs for tid, msgs in threads.items() if len(msgs) >= threshold}
 
     if not valid_threads:
-        lines.append(f"*没有符合条件的线程（消息数量 >= {threshold}）*")
-        return lines
+        out.write(f"*没有符合条件的线程（消息数量 >= {threshold}）*\n")
+        return
 
-    lines.append(f"**共 {len(valid_threads)} 个线程符合分析条件**")
-    lines.append("")
+    out.write(f"**共 {len(valid_threads)} 个线程符合分析条件**\n")
+    out.write("\n")
 
     tz_name = getattr(cfg.timezone, "key", None) or str(cfg.timezone)
 
-    # 创建消息ID到消息详情的映射（包括文本内容）
-    message_map: Dict[int, Dict[str, Any]] = {}
-    for row in rows:
-        message_map[row["message_id"]] = {
-            "text": row["text"] or "",
-            "user_id": row["user_id"],
-            "username": row["username"],
-        }
-
-    # 为每个符合条件的线程分别调用 AI 分析
-    for thread_id, thread_rows in sorted(valid_threads.items(), key=lambda x: len(x[1]), reverse=True):
-        thread_name = "普通消息" if thread_id == TOP_THREAD_ID else f"线程 {thread_id}"
-        total_messages = len(thread_rows)
-        lines.append(f"### 💭 {thread_name}（{total_messages} 条消息）")
-        lines.append("")
-
-        # 如果消息数量超过阈值，进行分段处理
-        if total_messages > cfg.ai_max_messages_per_batch:
-            batch_lines = _process_thread_batch(
-                thread_rows, thread_id, cfg, day_start, tz_name, chat_id, chat_name, chat_type, chat_link, message_map, conn
-            )
-            lines.extend(batch_lines)
-        else:
-            # 消息数量不多，直接处理
-            single_lines = _process_single_thread(
-                thread_rows, thread_id, cfg, day_start, tz_name, chat_id, chat_name, chat_type, chat_link, message_map, conn
-            )
-            lines.extend(single_lines)
+    # 所有待分析线程引用到的被回复消息只构建一次，不再按线程/批次分别查询
+    replied_map = _build_replied_map(conn, chat_id, rows_by_id, valid_threads)
 
-        lines.append("")
+    # 先在主线程中为所有线程（及批次）构建 payload，再并发调用 AI；
+    # 按原顺序渲染，某个线程的结果一就绪就写入报告，不等待全部请求完成
+    ordered_threads = sorted(valid_threads.items(), key=lambda x: len(x[1]), reverse=True)
+    thread_payloads = [
+        _prepare_thread_payloads(
+            thread_rows, thread_id, cfg, day_start, tz_name, chat_id, chat_name, chat_type, replied_map
+        )
+        for thread_id, thread_rows in ordered_threads
+    ]
+    semantic_cache = _semantic_cache(cfg)
+    outcomes = _iter_ai_outcomes(
+        cfg, [payload for payloads in thread_payloads for payload in payloads], semantic_cache
+    )
 
-    return lines
+    try:
+        for (thread_id, thread_rows), payloads in zip(ordered_threads, thread_payloads):
+            thread_outcomes = list(islice(outcomes, len(payloads)))
+            thread_name = "普通消息" if thread_id == TOP_THREAD_ID else f"线程 {thread_id}"
+            total_messages = len(thread_rows)
+            out.write(f"### 💭 {thread_name}（{total_messages} 条消息）\n")
+            out.write("\n")
+
+            # 消息数量超过 ai_max_messages_per_batch 时 payload 已被拆成多个批次
+            if len(payloads) > 1:
+                _render_thread_batch(out, thread_id, thread_outcomes, cfg, chat_link, preview_map)
+            else:
+                # 消息数量不多，直接处理
+                _render_single_thread(out, thread_id, thread_outcomes[0], chat_link, preview_map)
+
+            out.write("\n")
+    finally:
+        # 先关闭结果迭代器（等待线程池中的请求结束），再把本次新增的语义缓存条目统一写盘一次
+        outcomes.close()
+        if semantic_cache is not None:
+            semantic_cache.flush()